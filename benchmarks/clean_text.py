@@ -0,0 +1,88 @@
+import os
+import sys
+import html
+import time
+import random
+import urllib.request
+import feedparser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import services.utils as util
+
+# cleanText benchmark over captured feeds: previous html2text converter per call vs util.cleanText
+# capture a corpus:  python3 benchmarks/clean_text.py --capture [corpus_dir] [num_feeds]
+# run:               python3 benchmarks/clean_text.py [corpus_dir]
+# the legacy converter needs html2text installed
+
+DFLT_CORPUS = 'data/corpus'
+FEEDS_FILE = 'data/feeds.rss'
+
+def capture(corpus_dir, total):
+    os.makedirs(corpus_dir, exist_ok=True)
+    urls = [_l.strip() for _l in open(FEEDS_FILE, 'r') if _l.strip().startswith('http')]
+    random.shuffle(urls)
+    saved = 0
+    for i, url in enumerate(urls):
+        if saved >= total: break
+        try:
+            request = urllib.request.Request(url, headers={ 'User-Agent': 'index-flow rss crawler' })
+            with urllib.request.urlopen(request, timeout=15) as response:
+                content = response.read()
+            with open(os.path.join(corpus_dir, f"feed_{i:05d}.xml"), 'wb') as feed_file:
+                feed_file.write(content)
+            saved += 1
+        except Exception as error:
+            print(f"{url} -> {str(error)}")
+    print(f"captured {saved} feeds into '{corpus_dir}'")
+
+def corpus_texts(corpus_dir):
+    texts = []
+    for filename in sorted(os.listdir(corpus_dir)):
+        with open(os.path.join(corpus_dir, filename), 'rb') as feed_file:
+            feed = feedparser.parse(feed_file.read())
+        for _e in feed.get('entries', []):
+            content = _e.get('summary', _e.get('description', _e.get('text', _e.get('content', None))))
+            texts.append(_e.get('title', content or ''))
+            if isinstance(content, str): texts.append(content)
+    return texts
+
+def legacy_clean_text(text):
+    # previous util.cleanText
+    import html2text
+    text_maker = html2text.HTML2Text()
+    text_maker.ignore_links = True
+    text_maker.ignore_images = True
+    text = html.unescape(text)
+    text = text_maker.handle(text)
+    return text.strip().capitalize()
+
+def run(name, clean, texts):
+    started = time.perf_counter()
+    size = sum([len(clean(text)) for text in texts])
+    elapsed = time.perf_counter() - started
+    print(f"{name:<16} texts: {len(texts)}, chars out: {size}, secs: {elapsed:.3f}, texts/sec: {len(texts)/elapsed:.0f}")
+
+def run_batch(name, texts, processes):
+    util._cachedCleanText.cache_clear()
+    started = time.perf_counter()
+    size = sum([len(text) for text in util.cleanTexts(texts, processes)])
+    elapsed = time.perf_counter() - started
+    print(f"{name:<16} texts: {len(texts)}, chars out: {size}, secs: {elapsed:.3f}, texts/sec: {len(texts)/elapsed:.0f}")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--capture':
+        capture(sys.argv[2] if len(sys.argv) > 2 else DFLT_CORPUS, int(sys.argv[3]) if len(sys.argv) > 3 else 50)
+        sys.exit(0)
+    corpus_dir = sys.argv[1] if len(sys.argv) > 1 else DFLT_CORPUS
+    if not os.path.isdir(corpus_dir) or len(os.listdir(corpus_dir)) == 0:
+        print(f"no feeds in '{corpus_dir}', capture some first: python3 benchmarks/clean_text.py --capture {corpus_dir}")
+        sys.exit(1)
+    texts = corpus_texts(corpus_dir)
+    try:
+        run('legacy', legacy_clean_text, texts)
+    except ImportError:
+        print('legacy           html2text not installed, skipped')
+    util._cachedCleanText.cache_clear()
+    run('cleanText cold', util.cleanText, texts)
+    run('cleanText warm', util.cleanText, texts)
+    run_batch('cleanTexts x4', texts, 4)
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import datetime
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from services.idol import write_idx
+
+# IDX serializer benchmark: previous string concatenation + join/encode vs the streaming writer
+# usage: python3 benchmarks/idx_serializer.py [num_docs]
+
+def stock_documents(total):
+    date = datetime.datetime.now().isoformat()
+    for i in range(total):
+        symbol = f"SYM{i}"
+        yield {
+            'reference': f"US_{symbol}",
+            'dbname': 'STOCK',
+            'drecontent': f"Company {i} Incorporated",
+            'fields': [
+                ('LANGUAGE', 'GENERALUTF8'),
+                ('DATE', date),
+                ('TITLE', f"Company {i} Incorporated ({symbol})"),
+                ('DISPLAYSYMBOL', symbol),
+                ('SYMBOL_MATCH', symbol),
+                ('DESCRIPTION', f"COMPANY {i} INC"),
+                ('EXCHANGE_PARAM', 'US'),
+                ('EXCHANGE', 'NASDAQ NMS - GLOBAL MARKET'),
+                ('IPO_DATE', '1980-12-12'),
+                ('URL', f"https://www.company{i}.com/"),
+                ('LOGO', f"https://static.finnhub.io/logo/{i}.png"),
+                ('COUNTRY_PARAM', 'US'),
+                ('CURRENCY_PARAM', 'USD'),
+                ('FINNHUBINDUSTRY_PARAM', 'Technology'),
+                ('SHAREOUTSTANDING_NUM', 4443.27),
+                ('MARKETCAPITALIZATION_NUM', 1387428.0),
+                ('SINGLESHAREPRICE_NUM', 312.25)
+            ]
+        }
+
+def legacy_serializer(documents):
+    # previous idol._index_into_idol + post_index_data body construction
+    index_data = ''
+    for _d in documents:
+        fields = _d.get('fields', [])
+        content = _d.get('drecontent', '')
+        index_data += '\n'.join([
+        f"#DREREFERENCE {_d.get('reference')}"] +
+        [f"#DREFIELD {_f[0]}=\"{_f[1]}\"" for _f in fields] +
+        [f"#DRECONTENT",
+        f"{content}",
+        "#DREENDDOC\n\n"])
+    index_data = '\n'.join([index_data]) + "\n#DREENDDATAREFERENCE\n\n"
+    return len(index_data.encode('utf-8'))
+
+def streaming_serializer(documents):
+    # idol._index_into_idol materializes the encoded batch once, post_index_data streams it
+    index_data = bytearray()
+    for chunk in write_idx(documents):
+        index_data += chunk
+    return sum([len(chunk) for chunk in [index_data, b"\n#DREENDDATAREFERENCE\n\n"]])
+
+def run(name, serializer, total):
+    documents = list(stock_documents(total))
+    started = time.perf_counter()
+    size = serializer(documents)
+    elapsed = time.perf_counter() - started
+    # tracemalloc slows allocations down, peak memory is measured on a second run
+    tracemalloc.start()
+    serializer(documents)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} docs: {total}, bytes: {size}, secs: {elapsed:.3f}, docs/sec: {total/elapsed:.0f}, peak MB: {peak/1048576:.1f}")
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    run('legacy', legacy_serializer, total)
+    run('streaming', streaming_serializer, total)
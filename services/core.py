@@ -8,6 +8,7 @@ import pymongo
 import concurrent.futures
 import services.utils as util
 import services.elastic as elastic
+import services.idol as idol
 import services.doccano as doccano
 import services.spacynlp as spacynlp
 import services.scheduler as scheduler
@@ -41,6 +42,9 @@ class Service:
         self.mongo_projects = self.mongodb['projects']
         self.mongo_documents = self.mongodb['documents']
         self.mongo_role_mappings = self.mongodb['role_mappings']
+        self.mongo_feeds = self.mongodb['feeds']
+        self.mongo_profiles = self.mongodb['stock_profiles']
+        self.mongo_checkpoints = self.mongodb['stock_checkpoints']
         # db indices
         self.mongo_tasks.create_index([("enabled", 1), ("username", 1), ("projectid", 1), ("nextruntime", -1)])
         self.mongo_documents.create_index([("projectid", 1), ("id", 1)])
@@ -49,11 +53,16 @@ class Service:
         self.mongo_roles.create_index([("name", 1)])
         self.mongo_labels.create_index([("id", 1)])
         self.mongo_projects.create_index([("id", 1)])
+        self.mongo_feeds.create_index([("task_id", 1), ("url", 1)])
+        self.mongo_feeds.create_index([("task_id", 1), ("nextfetch", 1)])
+        self.mongo_profiles.create_index([("exchange", 1), ("symbol", 1)])
+        self.mongo_checkpoints.create_index([("task_id", 1), ("exchange", 1)])
         # core services setup
         self.index = elastic.Service(self.logging, self.config)
+        self.idol = idol.Service(self.logging, self.config) if self.config.get('idol') else None
         self.doccano = doccano.Service(self.logging, self.config, self.mongodb, self.index)
         self.spacynlp = spacynlp.Service(self.logging, self.config, self.mongodb, self.index)
-        self.scheduler = scheduler.Service(self.logging, self.config, self.mongodb, self.doccano, self.index, self.spacynlp)
+        self.scheduler = scheduler.Service(self.logging, self.config, self.mongodb, self.doccano, self.index, self.spacynlp, self.idol)
         if self.index.running and self.doccano.running and self.spacynlp.running and self.scheduler.running:
             logging.info(f"All services running! [Elastic: {'✔' if self.index.running else 'ERROR'}, Doccano: {'✔' if self.doccano.running else 'ERROR'}, SpacyNlp: {'✔' if self.spacynlp.running else 'ERROR'}, Scheduler: {'✔' if self.scheduler.running else 'ERROR'}]")
             self.running = True
@@ -76,10 +76,12 @@ class Service:
         export_ts_field = f"export_ts_prj_{proj_id}"
         train_ts_field = f"train_ts_prj_{proj_id}"
         export_field = f"export_prj_{proj_id}"
-        self.index.add_index_field(indices['indexdata'], import_ts_field, "long")
-        self.index.add_index_field(indices['indexdata'], export_ts_field, "long")
-        self.index.add_index_field(indices['indexdata'], train_ts_field, "long")
-        self.index.add_index_field(indices['indexdata'], export_field, "object")
+        self.index.add_index_fields(indices['indexdata'], {
+            import_ts_field: "long",
+            export_ts_field: "long",
+            train_ts_field: "long",
+            export_field: "object"
+        })
         
         # create the search query
         index_query ={
@@ -104,30 +106,47 @@ class Service:
         if remaining >= maxremaining:
             self.logging.warn(f"Doccano project '{task['name']}' is full [remaining: {remaining}, maxremaining: {maxremaining}]")
             return 0
+        created = [] # created in doccano, not stamped yet
+        total_created = 0
         imported = 0
-        for hit in self.index.query(index_query, indices['indexdata']):
-            text = hit.get('content', hit.get('title',  hit.get('text', hit.get('summary',''))))
-            if len(text) <3: continue # <3 :)
-            meta = {
-                "date": hit.get('date',''),
-                "url": hit.get('url', hit.get('link', '')),
-                "task": hit.get('indextask',hit.get('task_id','')),
-                "language": hit.get('language', hit.get('lang', 'unknow')),
-                "index": hit.get('index',''),
-                "id": hit['id']
-            }
-            # IMPORT VIA DOCCANO API
-            res = self.doccano_client.create_document(proj_id, text, json.dumps(meta))
-            if (res or {}).get('id', 0) > 0:
-                # ADD METADATA IN DOCUMENT TO AVOID IMPORT SAME DOC MULTIPLE TIMES
-                _res = self.index.update_fields(indices['indexdata'], hit['id'], { import_ts_field : int(time.time()) } )
-                if (_res or {}).get('result',None) == 'updated':
-                    imported += 1
-                else:
-                    self.logging.error(f"Error updating index field -> {_res}")
+        maxage = task['params'].get('maxage', 0)
+        search_indices = self.index.recent_partitions(indices['indexdata'], time.time()-maxage) if maxage > 0 else indices['indexdata']
+        hits = self.index.iter_query(index_query, search_indices, fields=['content', 'title', 'text', 'summary', 'date', 'url', 'link', 'indextask', 'task_id', 'language', 'lang'])
+        try:
+            for hit in hits:
+                if remaining + total_created >= maxremaining: break # stop paging once the project is full
+                text = hit.get('content', hit.get('title',  hit.get('text', hit.get('summary',''))))
+                if len(text) <3: continue # <3 :)
+                meta = {
+                    "date": hit.get('date',''),
+                    "url": hit.get('url', hit.get('link', '')),
+                    "task": hit.get('indextask',hit.get('task_id','')),
+                    "language": hit.get('language', hit.get('lang', 'unknow')),
+                    "index": hit.get('index',''),
+                    "id": hit['id']
+                }
+                # IMPORT VIA DOCCANO API
+                res = self.doccano_client.create_document(proj_id, text, json.dumps(meta))
+                if (res or {}).get('id', 0) > 0:
+                    created.append(hit['id'])
+                    total_created += 1
+                if len(created) >= task['params'].get('stampsize', 100):
+                    imported += self._stamp_imported(indices['indexdata'], created, import_ts_field)
+                    created = []
+        finally:
+            # ADD METADATA IN DOCUMENTS TO AVOID IMPORT SAME DOC MULTIPLE TIMES, also when the import stops halfway
+            hits.close()
+            imported += self._stamp_imported(indices['indexdata'], created, import_ts_field)
         self.logging.info(f"Total imported into project_{proj_id}: {imported}, query {index_query}")
         return imported
 
+    def _stamp_imported(self, index:str, ids:list, import_ts_field:str):
+        if len(ids) == 0: return 0
+        imported = self.index.update_by_ids(index, ids, { import_ts_field : int(time.time()) })
+        if imported != len(ids):
+            self.logging.error(f"Error updating index field '{import_ts_field}' -> {imported} of {len(ids)} updated")
+        return imported
+
     ### DOCCANO -> INDEX
     def export_from_doccano(self, task:dict):
         return self.executor.submit(self._export_from_doccano, task).result()
@@ -139,31 +158,38 @@ class Service:
         export_field = f"export_prj_{proj_id}"
         export_count = 0
         resp = self.doccano_client.get_doc_download(int(proj_id), 'json')
+        approved = []
         for line in resp.text.splitlines():
             doc = json.loads(line)            
             # only approved 
             if doc.get('annotation_approver',None) != None:
                 doc.update({"projectid" : proj_id})
-                meta = doc.get('meta',{})
-                doc_id = meta.get('id',None)
-                doc_indx = meta.get('index',None)                
-                ## update a field in the elastic search
-                _res = self.index.update_fields(doc_indx, doc_id, 
-                    {
-                        export_ts_field: int(time.time()),
-                        export_field : doc.get('annotations',[]),
-                        'content': doc.get('text')
-                    })
-                
-                if (_res or {}).get('result',None) == 'updated':
-                    res = self.doccano_client.delete_document(int(proj_id), doc.get('id'))
-                    if 200 <= res.status_code < 300:
-                        self.logging.info(f"Doc exported [doccano: {doc.get('id')} -> index: {doc_indx}, id: {doc_id}]")
-                        export_count += 1
-                    else:
-                        self.logging.error(f"Erro deleting from Doccano, code: {res.status_code}, proj_id: {proj_id}, doc_id: {doc.get('id')}")
+                approved.append(doc)
+
+        ## update the fields in the elastic search, all documents in chunked bulk requests
+        curr_time = int(time.time())
+        results = self.index.update_fields_bulk(
+            (_d.get('meta',{}).get('index',None), _d.get('meta',{}).get('id',None), 
+            {
+                export_ts_field: curr_time,
+                export_field : _d.get('annotations',[]),
+                'content': _d.get('text')
+            }) for _d in approved)
+
+        for doc in approved:
+            meta = doc.get('meta',{})
+            doc_id = meta.get('id',None)
+            doc_indx = meta.get('index',None)                
+            _res = results.get((doc_indx, str(doc_id)), None)
+            if _res in ('updated', 'noop'):
+                res = self.doccano_client.delete_document(int(proj_id), doc.get('id'))
+                if 200 <= res.status_code < 300:
+                    self.logging.info(f"Doc exported [doccano: {doc.get('id')} -> index: {doc_indx}, id: {doc_id}]")
+                    export_count += 1
                 else:
-                    self.logging.error(f"Error updating index field -> {_res}")
+                    self.logging.error(f"Erro deleting from Doccano, code: {res.status_code}, proj_id: {proj_id}, doc_id: {doc.get('id')}")
+            else:
+                self.logging.error(f"Error updating index field -> {_res}")
         return export_count
 
 
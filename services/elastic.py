@@ -1,14 +1,19 @@
 # pylint: disable=unexpected-keyword-arg
 
+import re
 import time
 import urllib
+import hashlib
+import contextlib
+import collections
 import logging
 import requests
 import threading
 from datetime import datetime
 import concurrent.futures
 from retrying import retry
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch.exceptions import ConflictError
 from requests.structures import CaseInsensitiveDict
 
 import services.utils as util
@@ -18,6 +23,11 @@ import services.utils as util
 # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html#query-string-syntax
 
 
+SHORT_TEXT_STOPWORDS = {
+    'en': { 'the', 'of', 'and', 'to', 'in', 'is', 'for', 'on', 'with', 'at', 'by', 'from', 'it', 'this', 'are', 'was' },
+    'pt': { 'de', 'da', 'do', 'e', 'em', 'para', 'com', 'os', 'as', 'no', 'na', 'um', 'uma', 'que', 'por', 'se', 'ao', 'dos', 'das' }
+}
+
 #self.detect_language("Qbox makes it easy for us to provision an Elasticsearch cluster without wasting time on all the details of cluster configuration.")
 ''' QUERY
 {
@@ -35,8 +45,17 @@ class Service:
         self.cfg = config.get('elastic').copy()
         self.lock = threading.Lock()
         self.index_queues = {}
-        self.numthreads = config.get('threads', 2)
+        self.mappings = {} # index -> (fetch time, field names), known indices and their fields
+        self.mappings_ttl = self.cfg.get('mappingttl', 600)
+        self.lang_cache = collections.OrderedDict() # content md5 -> language, LRU
+        self.lang_cache_stats = { 'hits': 0, 'misses': 0 }
+        self.bulk_loads = {} # index -> (active loads, settings to restore)
+        self.numthreads = self.cfg.get('threads', config.get('threads', 2))
+        self.write_slots = threading.BoundedSemaphore(self.cfg.get('writequeue', self.numthreads))
+        self.write_cond = threading.Condition()
+        self.writes_pending = 0
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.numthreads, thread_name_prefix='ElasticPool')
+        self.maintenance = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ElasticMaintenance') # long running calls, off the shared pool
         self.running = self.executor.submit(self.initService).result()
     
     def initService(self):
@@ -63,33 +82,103 @@ class Service:
         for tp, idx in indices.items():
             self._create_index(idx, tp == "filters")
         
-    def index_documents(self, documents:list, index:str):
-        return self.executor.submit(self._index_documents, documents, index).result()
+    def index_documents(self, documents, index:str, replace=True):
+        return self.executor.submit(self._index_documents, documents, index, replace).result()
+
+    def _index_documents(self, documents, index:str, replace=True):
+        stats = { 'indexed': 0, 'skipped': 0, 'errors': 0 }
+        bulksize = self.cfg.get('bulksize', 500)
+        if not replace and self._rollover_conditions() != None:
+            documents = self._absent_documents(documents, index, bulksize, stats)
+        actions = self._bulk_actions(documents, index, replace)
+        for ok, item in helpers.streaming_bulk(self.elastic, actions, chunk_size=bulksize, max_chunk_bytes=self.cfg.get('bulkbytes', 10485760),
+                raise_on_error=False, raise_on_exception=False, pipeline='index-pipeline'):
+            if ok:
+                stats['indexed'] += 1
+            elif self._is_conflict(item): # create on an existing _id, already present
+                stats['skipped'] += 1
+            else:
+                stats['errors'] += 1
+                self.logging.error(f"ElasticService: {item}")
+        self.logging.debug(f"bulk index into {index}: {stats}")
+        return stats
 
-    def _index_documents(self, documents:list, index:str):
-        total = 0
+    def _bulk_actions(self, documents, index:str, replace:bool):
         for doc in documents:
-            total += self._index_document(doc, index)
-        return total
+            _id = self._document_id(doc)
+            action = { '_op_type': 'index' if replace else 'create', '_index': index, '_source': { k:v for k,v in doc.items() if k != '_id' } }
+            if _id != None: action['_id'] = str(_id)
+            yield action
+
+    def _absent_documents(self, documents, index:str, bulksize:int, stats:dict):
+        # op_type=create only sees the write partition, ids already in an older partition are skipped here
+        for chunk in util.chunks(documents, bulksize):
+            ids = [str(_id) for _id in [self._document_id(doc) for doc in chunk] if _id != None]
+            existing = set()
+            if len(ids) > 0:
+                res = self.elastic.search(index=index, body={ "query": { "ids": { "values": ids } }, "_source": False, "size": len(ids) })
+                existing = set([hit['_id'] for hit in res.get('hits', {}).get('hits', [])])
+            for doc in chunk:
+                if str(self._document_id(doc)) in existing:
+                    stats['skipped'] += 1
+                else:
+                    yield doc
+
+    def _is_conflict(self, item:dict):
+        return any([(res or {}).get('status', 0) == 409 for res in (item or {}).values()])
+
+    def _document_id(self, document:dict):
+        return document.get('_id', document.get('id', document.get('ref', None)))
+
+    def write(self, documents, index:str, replace=True):
+        # sink interface: asynchronous bulk write, returns a future with the bulk stats
+        # at most 'writequeue' bulks in flight, then the caller waits (backpressure)
+        documents = [util.idolToElastic(doc) if 'reference' in doc else doc for doc in documents]
+        self.write_slots.acquire()
+        with self.write_cond:
+            self.writes_pending += 1
+        future = self.executor.submit(self._index_documents, documents, index, replace)
+        future.add_done_callback(self._written)
+        return future
+
+    def _written(self, future):
+        self.write_slots.release()
+        with self.write_cond:
+            self.writes_pending -= 1
+            self.write_cond.notify_all()
+
+    def request_flush(self):
+        # writes are submitted as they come, nothing is held back
+        return
+
+    def flush(self, timeout=None):
+        with self.write_cond:
+            return self.write_cond.wait_for(lambda: self.writes_pending == 0, timeout=timeout)
+
+    def delete(self, ids:list, index:str):
+        return self.executor.submit(self._delete, ids, index).result()
+
+    def _delete(self, ids:list, index:str):
+        actions = [{ '_op_type': 'delete', '_index': index, '_id': str(_id) } for _id in ids]
+        deleted, errors = helpers.bulk(self.elastic, actions, chunk_size=self.cfg.get('bulksize', 500), raise_on_error=False)
+        return { 'deleted': deleted, 'errors': len(errors) }
 
     def index_document(self, document:dict, index:str, replace=True):
         return self.executor.submit(self._index_document, document, index, replace).result()
 
     def _index_document(self, document:dict, index:str, replace=True):
         try:
-            _id = document.get('_id', document.get('id', document.get('ref', None)))
+            _id = self._document_id(document)
+            body = { k:v for k,v in document.items() if k != '_id' }
+            if not replace and self._rollover_conditions() != None and len(list(self._absent_documents([document], index, 1, { 'skipped': 0 }))) == 0:
+                return 0
             if replace:
-                self.elastic.index(index=index, body=document, id=_id, pipeline='index-pipeline')
+                self.elastic.index(index=index, body=body, id=_id, pipeline='index-pipeline')
             else:
-                res = self.elastic.count(body={
-                    "query": {
-                        "terms": { "_id": [ _id ]  }
-                    }}, index=index)
-                if (res or {}).get('count',0) == 0:
-                    self.elastic.index(index=index, body=document, id=_id, pipeline='index-pipeline')
-                else:
-                    return 0
+                self.elastic.index(index=index, body=body, id=_id, pipeline='index-pipeline', op_type='create')
             return 1
+        except ConflictError:
+            return 0
         except Exception as error:
             self.logging.error(f"ElasticService: {error}")
             return 0
@@ -106,24 +195,48 @@ class Service:
     def _query(self, query:dict, index:str): 
         res = self.elastic.search(index=index, body=query)
         hits = res.get('hits', {}).get('hits', [])
-        hits = [dict({'id':hit['_id'], 'index':hit['_index'], 'score':hit['_score']*100.0 }, **hit['_source']) for hit in hits]
+        hits = [self._hit(hit) for hit in hits]
         return hits
 
+    def iter_query(self, query:dict, index:str, pagesize=None, fields=None):
+        # pages through the whole result set with a scroll, only one page is held in memory
+        params = {}
+        if fields != None: params['_source'] = fields
+        query = { k:v for k,v in query.items() if k not in ('from', 'size') }
+        # pre_filter_shard_size=1 lets date range queries skip partitions that can't match
+        for hit in helpers.scan(self.elastic, query=query, index=index, size=pagesize or self.cfg.get('pagesize', 500), scroll=self.cfg.get('scroll', '5m'), pre_filter_shard_size=1, **params):
+            yield self._hit(hit)
+
+    def _hit(self, hit:dict):
+        return dict({'id':hit['_id'], 'index':hit['_index'], 'score':(hit.get('_score') or 0)*100.0 }, **hit.get('_source', {}))
+
     def search_filters(self, text:str, index:str):
         return self.executor.submit(self._search_filters, text, index).result()
 
     def _search_filters(self, text:str, index:str):
+        return self._search_filters_batch([text], index)[0]
+
+    def search_filters_batch(self, texts:list, index:str):
+        return self.executor.submit(self._search_filters_batch, texts, index).result()
+
+    def _search_filters_batch(self, texts:list, index:str):
+        # percolate all texts in one request, each hit tells which document slots it matched
+        matches = [[] for _t in texts]
+        if len(texts) == 0: return matches
         query = {
+            "size": self.cfg.get('maxfilters', 1000),
             "query": {
                 "percolate" : {
                     "field" : "query",
-                    "document" : {
-                        "content" : text
-                    }
+                    "documents" : [ { "content" : text } for text in texts ]
                 }
             }
         }
-        return self.query(query, index)
+        res = self.elastic.search(index=index, body=query)
+        for hit in res.get('hits', {}).get('hits', []):
+            for slot in hit.get('fields', {}).get('_percolator_document_slot', [0]):
+                matches[slot].append(self._hit(hit))
+        return matches
 
     def addIndexFilter(self, index:str, title:str, query:str):
         return self.executor.submit(self._addIndexFilter, index, title, query).result()
@@ -152,67 +265,265 @@ class Service:
         return self.elastic.update(index, _id, body)
 
 
+    def update_fields_bulk(self, updates):
+        return self.executor.submit(self._update_fields_bulk, updates).result()
+
+    def _update_fields_bulk(self, updates):
+        # updates is an iterable of (index, _id, fields), results are keyed by (index, _id)
+        results = {}
+        actions = ({ '_op_type': 'update', '_index': index, '_id': str(_id), 'doc': fields } for index, _id, fields in updates)
+        for ok, item in helpers.streaming_bulk(self.elastic, actions, chunk_size=self.cfg.get('bulksize', 500), max_chunk_bytes=self.cfg.get('bulkbytes', 10485760),
+                raise_on_error=False, raise_on_exception=False):
+            res = item.get('update', {})
+            results[(res.get('_index'), res.get('_id'))] = res.get('result') if ok else res.get('error', res.get('status'))
+            if not ok: self.logging.error(f"ElasticService: {item}")
+        return results
+
+    def update_by_ids(self, index:str, ids:list, fields:dict):
+        return self.executor.submit(self._update_by_ids, index, ids, fields).result()
+
+    def _update_by_ids(self, index:str, ids:list, fields:dict):
+        # stamps the same fields on all ids server side, one update_by_query per chunk of ids
+        updated = 0
+        script = {
+            "source": "for (entry in params.fields.entrySet()) { ctx._source[entry.getKey()] = entry.getValue(); }",
+            "lang": "painless",
+            "params": { "fields": fields }
+        }
+        for chunk in util.chunks(ids, self.cfg.get('bulksize', 500)):
+            body = { "script": script, "query": { "ids": { "values": [str(_id) for _id in chunk] } } }
+            res = self.elastic.update_by_query(index=index, body=body, conflicts='proceed', refresh=True)
+            updated += res.get('updated', 0)
+            for failure in res.get('failures', []):
+                self.logging.error(f"ElasticService: {failure}")
+        return updated
+
     def add_index_field(self, index:str, fieldname:str, _type="keyword"):
-        return self.executor.submit(self._add_index_field, index, fieldname, _type).result()
+        return self.executor.submit(self._add_index_fields, index, { fieldname: _type }).result()
 
-    def _add_index_field(self, index:str, fieldname:str, _type:str):
-        curr_map = self.elastic.indices.get_mapping(index=index)
-        curr_prop = curr_map.get(index,{}).get('mappings',{}).get('properties',{})
-        if curr_prop.get(fieldname, None) != None:
-            self.logging.debug(f"field {fieldname} already exists in index {index}")
+    def add_index_fields(self, index:str, fields:dict):
+        return self.executor.submit(self._add_index_fields, index, fields).result()
+
+    def _add_index_fields(self, index:str, fields:dict):
+        # only the missing fields are sent, all of them in a single put_mapping
+        known = self._index_fields(index)
+        missing = { str(name): { "type": _type } for name, _type in fields.items() if name not in known }
+        if len(missing) == 0:
+            self.logging.debug(f"fields {list(fields.keys())} already exists in index {index}")
             return {}
-        body = {
-            "properties": {
-                str(fieldname): {
-                    "type": _type
-                }
-            }
-        }
-        self.logging.debug(f"creating field {fieldname} in index {index}")
-        return self.elastic.indices.put_mapping(body, index=index)
+        self.logging.debug(f"creating fields {list(missing.keys())} in index {index}")
+        res = self.elastic.indices.put_mapping({ "properties": missing }, index=index)
+        self._register_index(index, known | set(missing.keys()))
+        return res
+
+    def _index_fields(self, index:str):
+        with self.lock:
+            cached = self.mappings.get(index, None)
+        if cached != None and time.time() - cached[0] < self.mappings_ttl:
+            return cached[1]
+        curr_map = self.elastic.indices.get_mapping(index=self._write_index(index))
+        fields = set()
+        for _idx, _map in curr_map.items():
+            fields |= set(_map.get('mappings',{}).get('properties',{}).keys())
+        self._register_index(index, fields)
+        return fields
+
+    def _write_index(self, index:str):
+        # behind a rollover alias only the partition written to tells which fields are missing, a fresh one has none of the added ones
+        if not self.elastic.indices.exists_alias(name=index):
+            return index
+        for _idx, _a in self.elastic.indices.get_alias(name=index).items():
+            if _a.get('aliases', {}).get(index, {}).get('is_write_index', False):
+                return _idx
+        return index
+
+    def _register_index(self, index:str, fields:set):
+        with self.lock:
+            self.mappings[index] = (time.time(), fields)
+
+    def _is_known_index(self, index:str):
+        with self.lock:
+            cached = self.mappings.get(index, None)
+        return cached != None and time.time() - cached[0] < self.mappings_ttl
+
+    def invalidate_mappings(self, index=None):
+        with self.lock:
+            if index == None: self.mappings.clear()
+            else: self.mappings.pop(index, None)
 
     def create_index(self, index:str, filtr=False):
         return self.executor.submit(self._create_index, index, filtr).result()
 
     def _create_index(self, index:str, filtr=False):
-        if not self.elastic.indices.exists(index):
-            body = {
-                "settings" : {
-                    "number_of_shards" : 1,
-                    "number_of_replicas" : 1
-                },
-                "mappings" : { }
-            }
-            if filtr:
-                body['mappings']['properties'] = {
-                    "title" : { "type": "text", "index": False },
-                    "query":  { "type": "percolator" },
-                    "content":{ "type": "text" }
-                }
-            else:
-                body['mappings']['properties'] = {
-                    "id" :   { "type": "keyword" },
-                    "title" :   { "type": "text" },
-                    "content":  { "type": "text" },  
-                    "language": { "type": "keyword"},
-                    "date":     { "type": "date" },
-                    "url":      { "type": "keyword", "index": False },
-                    "src":      { "type": "keyword", "index": False },
-                    "indextask":{ "type": "keyword"},
-                    "task_id":  { "type": "keyword"},
-                    "filter":   { "type": "object"}
-                }
+        if self._is_known_index(index):
+            return
+        if self.elastic.indices.exists(index):
+            self._index_fields(index)
+        else:
+            body = self._index_template('filters' if filtr else 'indexdata')
             try:
-                res = self.elastic.indices.create(index, body=body)
+                if not filtr and self._rollover_conditions() != None:
+                    # time partitioned, 'index' becomes the alias: writes go to the newest partition, reads span all
+                    body['aliases'] = { index: { "is_write_index": True } }
+                    res = self.elastic.indices.create(f"{index}-000001", body=body)
+                else:
+                    res = self.elastic.indices.create(index, body=body)
+                self._register_index(index, set(body['mappings']['properties'].keys()))
                 self.logging.info(f"create index {res}")
                 return res
             except Exception as error:
                 self.logging.error(f"ElasticSearch: {error}")
 
+    def _index_template(self, tp:str):
+        # per user index names are hashes, so the templates are applied at creation time from the config
+        template = self.cfg.get('templates', {}).get(tp, {})
+        body = {
+            "settings" : {
+                "number_of_shards" : template.get('shards', 1),
+                "number_of_replicas" : template.get('replicas', 1)
+            },
+            "mappings" : { }
+        }
+        if template.get('codec', None) != None:
+            body['settings']['codec'] = template['codec']
+        if template.get('refresh', None) != None:
+            body['settings']['refresh_interval'] = template['refresh']
+        if tp == 'filters':
+            body['mappings']['properties'] = {
+                "title" : { "type": "text", "index": False },
+                "query":  { "type": "percolator" },
+                "content":{ "type": "text" }
+            }
+        else:
+            body['mappings']['properties'] = {
+                "id" :   { "type": "keyword" },
+                "title" :   { "type": "text" },
+                "content":  { "type": "text" },  
+                "language": { "type": "keyword"},
+                "date":     { "type": "date" },
+                "url":      { "type": "keyword", "index": False },
+                "src":      { "type": "keyword", "index": False },
+                "indextask":{ "type": "keyword"},
+                "task_id":  { "type": "keyword"},
+                "filter":   { "type": "object"}
+            }
+        return body
+
+    def _rollover_conditions(self):
+        return self.cfg.get('templates', {}).get('indexdata', {}).get('rollover', None)
+
+    def rollover(self, index:str):
+        return self.executor.submit(self._rollover, index).result()
+
+    def _rollover(self, index:str):
+        conditions = self._rollover_conditions()
+        if conditions == None or not self.elastic.indices.exists_alias(name=index):
+            return {}
+        body = self._index_template('indexdata')
+        body['conditions'] = conditions
+        res = self.elastic.indices.rollover(index, body=body)
+        if res.get('rolled_over', False):
+            self.logging.info(f"index {index} rolled over [{res.get('old_index')} -> {res.get('new_index')}]")
+            self.invalidate_mappings(index)
+            self.maintenance.submit(self._seal_partition, res.get('old_index'))
+        return res
+
+    def _seal_partition(self, partition:str):
+        # old partitions only receive field updates (import/train timestamps), so they stay writable and are just merged down
+        try:
+            self.elastic.indices.forcemerge(index=partition, max_num_segments=1, request_timeout=3600)
+            self.logging.info(f"partition {partition} sealed")
+        except Exception as error:
+            self.logging.error(f"ElasticSearch: {error}")
+
+    def recent_partitions(self, index:str, since:int):
+        return self.executor.submit(self._recent_partitions, index, since).result()
+
+    def _recent_partitions(self, index:str, since:int):
+        # a partition holds documents from its creation until the next one is created
+        if not self.elastic.indices.exists_alias(name=index):
+            return index
+        res = self.elastic.indices.get_settings(index=index, name='index.creation_date', flat_settings=True)
+        created = sorted([(int(_s.get('settings', {}).get('index.creation_date', 0))/1000, _idx) for _idx, _s in res.items()])
+        recent = [_idx for i, (_ts, _idx) in enumerate(created) if i+1 == len(created) or created[i+1][0] >= since]
+        return ','.join(recent)
+
+    @contextlib.contextmanager
+    def bulk_load(self, index:str):
+        self.begin_bulk_load(index)
+        try:
+            yield self
+        finally:
+            self.end_bulk_load(index)
+
+    def begin_bulk_load(self, index:str):
+        return self.executor.submit(self._begin_bulk_load, index).result()
+
+    def _begin_bulk_load(self, index:str):
+        # refresh off and no replicas while loading, nested/concurrent loads on the same index share it
+        with self.lock:
+            loading = self.bulk_loads.get(index, None)
+            if loading != None:
+                self.bulk_loads[index] = (loading[0]+1, loading[1])
+                return
+            self.bulk_loads[index] = (1, {})
+        try:
+            res = self.elastic.indices.get_settings(index=index, name='index.refresh_interval,index.number_of_replicas', flat_settings=True)
+            previous = { _idx: _s.get('settings', {}) for _idx, _s in res.items() }
+            with self.lock:
+                self.bulk_loads[index] = (self.bulk_loads[index][0], previous)
+            self.elastic.indices.put_settings({ "index": { "refresh_interval": "-1", "number_of_replicas": 0 } }, index=index)
+            self.logging.info(f"bulk load started on {index} {previous}")
+        except Exception as error:
+            self.logging.error(f"ElasticSearch: {error}")
+
+    def end_bulk_load(self, index:str):
+        return self.executor.submit(self._end_bulk_load, index).result()
+
+    def _end_bulk_load(self, index:str):
+        with self.lock:
+            loading = self.bulk_loads.get(index, None)
+            if loading == None: return
+            if loading[0] > 1:
+                self.bulk_loads[index] = (loading[0]-1, loading[1])
+                return
+            self.bulk_loads.pop(index)
+        try:
+            for _idx, settings in loading[1].items():
+                self.elastic.indices.put_settings({ "index": { 
+                    "refresh_interval": settings.get('index.refresh_interval', None), 
+                    "number_of_replicas": settings.get('index.number_of_replicas', 1) 
+                } }, index=_idx)
+            self.elastic.indices.refresh(index=index)
+            self.logging.info(f"bulk load finished on {index}")
+        except Exception as error:
+            self.logging.error(f"ElasticSearch: {error}")
+
     def detect_language(self, text:str):
         return self.executor.submit(self._detect_language, text).result()
 
     def _detect_language(self, text:str):
+        return self._detect_languages([text])[0]
+
+    def detect_languages(self, texts:list):
+        return self.executor.submit(self._detect_languages, texts).result()
+
+    def _detect_languages(self, texts:list):
+        # cached and very short texts are resolved locally, the rest goes in a single simulate call
+        langs = [None] * len(texts)
+        pending = {}
+        for i, text in enumerate(texts):
+            key = hashlib.md5((text or '').encode('utf-8')).hexdigest()
+            if key in pending: # repeated in this batch, already looked up once
+                pending[key][1].append(i)
+                continue
+            lang = self._cached_language(key)
+            if lang == None and len((text or '').split()) < self.cfg.get('langshortwords', 4):
+                lang = self._short_text_language(text)
+                if lang != None: self._cache_language(key, lang)
+            if lang != None: langs[i] = lang
+            else: pending[key] = (text, [i])
+        if len(pending) == 0: return langs
         body = {
             "pipeline" :
             {
@@ -229,21 +540,52 @@ class Service:
             "docs": [
                 {
                     "_index": "index",
-                    "_id": "id",
+                    "_id": key,
                     "_source": {
                         "content": text
                     }
-                }
+                } for key, (text, _) in pending.items()
             ]
         }
         try:
             res = self.elastic.ingest.simulate(body)
-            lang = res.get('docs',[{}])[0].get('doc',{}).get('_source',{}).get('language', 'unknown')
-            return lang
+            for key, doc in zip(pending.keys(), res.get('docs',[])):
+                lang = (doc or {}).get('doc',{}).get('_source',{}).get('language', 'unknown')
+                self._cache_language(key, lang)
+                for i in pending[key][1]: langs[i] = lang
         except Exception as error:
             self.logging.error(f"ElasticSearch: {error}")
-        
-    
+        return langs
+
+    def _short_text_language(self, text:str):
+        # stopwords vote for very short texts, undecided ones (no stopword or a tie) go to langdetect
+        words = set(re.findall(r'\w+', (text or '').lower()))
+        votes = { lang: len(words & stopwords) for lang, stopwords in SHORT_TEXT_STOPWORDS.items() }
+        lang, count = max(votes.items(), key=lambda _v: _v[1])
+        if count == 0 or list(votes.values()).count(count) > 1: return None
+        return lang
+
+    def _cached_language(self, key:str):
+        with self.lock:
+            lang = self.lang_cache.get(key, None)
+            if lang == None:
+                self.lang_cache_stats['misses'] += 1
+                return None
+            self.lang_cache.move_to_end(key)
+            self.lang_cache_stats['hits'] += 1
+            return lang
+
+    def _cache_language(self, key:str, lang:str):
+        with self.lock:
+            self.lang_cache[key] = lang
+            self.lang_cache.move_to_end(key)
+            while len(self.lang_cache) > self.cfg.get('langcache', 10000):
+                self.lang_cache.popitem(last=False)
+
+    def language_cache_status(self):
+        with self.lock:
+            return dict(self.lang_cache_stats, size=len(self.lang_cache))
+
     def _create_pipelines(self):
         body = {
             "description" : "Indexing pre-processors",
@@ -0,0 +1,251 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+# In-process matcher for IDX filter agents (data/FILTERS.idx)
+# AGENT_BOOL syntax: terms, "quoted phrases", prefix*, ( ), OR, AND, NOT, AND NOT,
+# NEAR / WNEAR (any order) and DNEAR (in order) with optional distance, eg: DNEAR3 or NEAR/10
+# implicit operator between terms is AND, precedence is: proximity > AND/NOT > OR
+
+DFLT_DISTANCE = 6
+AGENT_FIELD = 'AGENT_BOOL'
+re_words = re.compile(r'\w+')
+re_query_token = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+re_proximity = re.compile(r'^(D|W)?NEAR(?:/?(\d+))?$')
+re_idx_field = re.compile(r'^#DREFIELD\s+([^=]+)="(.*)"\s*$')
+
+def normalize(text:str):
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join([c for c in text if not unicodedata.combining(c)]).lower()
+
+def tokenize(text:str):
+    return re_words.findall(normalize(text))
+
+def read_idx(filename:str):
+    record = None
+    with open(filename, 'r', encoding='utf-8') as idx_file:
+        for line in idx_file:
+            line = line.rstrip('\n')
+            if line.startswith('#DREREFERENCE'):
+                record = { 'reference': line[len('#DREREFERENCE'):].strip(), 'fields': defaultdict(list), 'content': '' }
+            elif record == None:
+                continue
+            elif line.startswith('#DREFIELD'):
+                field = re_idx_field.match(line)
+                if field: record['fields'][field.group(1).strip().upper()].append(field.group(2))
+            elif line.startswith('#DREENDDOC'):
+                yield record
+                record = None
+            elif not line.startswith('#DRECONTENT'):
+                record['content'] += line + '\n'
+
+
+class Document:
+
+    def __init__(self, text:str):
+        self.tokens = tokenize(text)
+        self.positions = defaultdict(list)
+        for pos, word in enumerate(self.tokens):
+            self.positions[word].append(pos)
+
+    def spans(self, word:str, prefix=False):
+        if not prefix:
+            return [(p, p) for p in self.positions.get(word, [])]
+        return sorted([(p, p) for w, positions in self.positions.items() if w.startswith(word) for p in positions])
+
+
+class Term:
+
+    def __init__(self, word:str):
+        self.prefix = word.endswith('*')
+        self.word = word.rstrip('*')
+
+    def terms(self):
+        return { (self.word, self.prefix) }
+
+    def spans(self, doc:Document):
+        return doc.spans(self.word, self.prefix)
+
+
+class Phrase:
+
+    def __init__(self, words:list):
+        self.words = words
+
+    def terms(self):
+        return { (self.words[0], False) }
+
+    def spans(self, doc:Document):
+        size = len(self.words)
+        return [(p, p+size-1) for p in doc.positions.get(self.words[0], []) if doc.tokens[p:p+size] == self.words]
+
+
+class Or:
+
+    def __init__(self, nodes:list):
+        self.nodes = nodes
+
+    def terms(self):
+        return set().union(*[n.terms() for n in self.nodes])
+
+    def spans(self, doc:Document):
+        return [s for n in self.nodes for s in n.spans(doc)]
+
+
+class And(Or):
+
+    def spans(self, doc:Document):
+        spans = []
+        for n in self.nodes:
+            _s = n.spans(doc)
+            if len(_s) == 0: return []
+            spans += _s
+        return spans
+
+
+class Not:
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def terms(self):
+        return self.left.terms()
+
+    def spans(self, doc:Document):
+        return self.left.spans(doc) if len(self.right.spans(doc)) == 0 else []
+
+
+class Near:
+
+    def __init__(self, left, right, distance=DFLT_DISTANCE, ordered=False):
+        self.left = left
+        self.right = right
+        self.distance = distance
+        self.ordered = ordered
+
+    def terms(self):
+        return self.left.terms() | self.right.terms()
+
+    def spans(self, doc:Document):
+        right = self.right.spans(doc)
+        if len(right) == 0: return []
+        spans = []
+        for a in self.left.spans(doc):
+            for b in right:
+                if (0 < b[0]-a[1] <= self.distance) or (not self.ordered and 0 < a[0]-b[1] <= self.distance):
+                    spans.append((min(a[0], b[0]), max(a[1], b[1])))
+        return spans
+
+
+class Parser:
+
+    def __init__(self, expression:str):
+        self.tokens = re_query_token.findall(expression or '')
+        self.pos = 0
+
+    def parse(self):
+        node = self._or()
+        if self._peek() != None:
+            raise Exception(f"unexpected '{self._peek()}' at token {self.pos}")
+        return node
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _or(self):
+        nodes = [self._and()]
+        while self._peek() == 'OR':
+            self._next()
+            nodes.append(self._and())
+        return nodes[0] if len(nodes) == 1 else Or(nodes)
+
+    def _and(self):
+        node = self._near()
+        while self._peek() not in (None, 'OR', ')'):
+            if self._peek() == 'AND': self._next()
+            if self._peek() == 'NOT':
+                self._next()
+                node = Not(node, self._near())
+            else:
+                node = And([node, self._near()])
+        return node
+
+    def _near(self):
+        node = self._atom()
+        while self._peek() != None and re_proximity.match(self._peek()):
+            op = re_proximity.match(self._next())
+            distance = int(op.group(2)) if op.group(2) else DFLT_DISTANCE
+            node = Near(node, self._atom(), distance, op.group(1) == 'D')
+        return node
+
+    def _atom(self):
+        token = self._next()
+        if token == None:
+            raise Exception('unexpected end of expression')
+        if token == '(':
+            node = self._or()
+            if self._next() != ')':
+                raise Exception("missing ')'")
+            return node
+        if token == ')' or token in ('OR', 'AND', 'NOT') or re_proximity.match(token):
+            raise Exception(f"unexpected '{token}' at token {self.pos-1}")
+        prefix = token.endswith('*') and not token.startswith('"')
+        words = tokenize(token)
+        if len(words) == 0:
+            raise Exception(f"invalid term '{token}'")
+        if len(words) > 1:
+            return Phrase(words)
+        return Term(words[0] + ('*' if prefix else ''))
+
+
+class Matcher:
+
+    def __init__(self, logging):
+        self.logging = logging
+        self.filters = {}
+        self.term_index = defaultdict(set)
+        self.prefix_index = defaultdict(set)
+
+    def add_filter(self, _id:str, title:str, expression:str):
+        try:
+            node = Parser(expression).parse()
+        except Exception as error:
+            self.logging.error(f"filter '{_id}': {expression} -> {str(error)}")
+            return False
+        self.filters[_id] = (title, node)
+        for word, prefix in node.terms():
+            (self.prefix_index if prefix else self.term_index)[word].add(_id)
+        return True
+
+    def load_idx(self, filename:str, field=AGENT_FIELD):
+        for record in read_idx(filename):
+            for expression in record['fields'].get(field, []):
+                title = (record['fields'].get('TITLE') or [record['reference']])[0]
+                self.add_filter(record['reference'], title, expression)
+        self.logging.info(f"Filters loaded from '{filename}': {len(self.filters)}")
+        return self
+
+    def match(self, text:str):
+        # only filters sharing at least one term with the document are evaluated
+        doc = Document(text)
+        candidates = set()
+        for word in doc.positions:
+            candidates |= self.term_index.get(word, set())
+        for prefix, ids in self.prefix_index.items():
+            if any([word.startswith(prefix) for word in doc.positions]):
+                candidates |= ids
+        matches = {}
+        for _id in candidates:
+            title, node = self.filters[_id]
+            if len(node.spans(doc)) > 0:
+                matches[_id] = title
+        return matches
+
+    def match_batch(self, texts:list):
+        return [self.match(text) for text in texts]
@@ -1,9 +1,14 @@
 
 
+import re
 import time
+import atexit
+import itertools
 import urllib
+import zlib
 import logging
 import requests
+import requests.adapters
 import threading
 import concurrent.futures
 from retrying import retry
@@ -11,84 +16,213 @@ from requests.structures import CaseInsensitiveDict
 
 import services.utils as util
 
+re_idx_command = re.compile(r'^(?=#DRE)', re.MULTILINE)
+
+def idx_line(value):
+    value = str(value)
+    if '\n' in value or '\r' in value:
+        return value.replace('\r', ' ').replace('\n', ' ')
+    return value
+
+def idx_escape(value):
+    # field values are single line and quoted, backslashes first so added escapes stay as they are
+    value = idx_line(value)
+    if '\\' in value: value = value.replace('\\', '\\\\')
+    return value.replace('"', '\\"') if '"' in value else value
+
+def idx_content(text):
+    # content lines starting like an IDX command would end the document early
+    text = str(text)
+    return re_idx_command.sub(' ', text) if '#DRE' in text else text
+
+def idx_fields(fields):
+    # written as is unless some value has quotes, backslashes or line breaks, checked once on the whole block
+    block = ''.join([f'#DREFIELD {_f[0]}="{_f[1]}"\n' for _f in fields])
+    if block.count('"') != 2*len(fields) or block.count('\n') != len(fields) or '\\' in block or '\r' in block:
+        block = ''.join([f'#DREFIELD {_f[0]}="{idx_escape(_f[1])}"\n' for _f in fields])
+    return block
+
+def write_idx(documents, encoding='utf-8'):
+    # yields one encoded IDX record per document
+    for _d in documents:
+        fields = _d.get('fields', [])
+        content = str(_d.get('drecontent', ''))
+        DOCUMENTS = _d.get('content',{}).get('DOCUMENT',[])
+        if len(DOCUMENTS) > 0:
+            fields = list(fields)
+            content = [content]
+            for DOC in DOCUMENTS:
+                for key in DOC:
+                    if key == 'DRECONTENT':
+                        content += [str(value) for value in DOC[key]]
+                    else:
+                        fields += [(key, value) for value in DOC[key]]
+            content = ''.join(content)
+        yield f"#DREREFERENCE {_d.get('reference')}\n{idx_fields(fields)}#DRECONTENT\n{idx_content(content)}\n#DREENDDOC\n\n".encode(encoding)
+
+def reference_chunks(references, maxchars, separator):
+    # splits references so each joined and url encoded chunk stays under 'maxchars'
+    chunks = []
+    chunk = []
+    size = 0
+    for reference in references:
+        length = len(urllib.parse.quote_plus(str(reference))) + len(separator)
+        if len(chunk) > 0 and size + length > maxchars:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(reference)
+        size += length
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data: yield data
+    yield compressor.flush()
+
+class AciClient:
+
+    # keep-alive connection pool to one ACI endpoint (DAH or DIH)
+    def __init__(self, component:dict, poolsize=10, timeout=60, gzip=False):
+        self.url = util.makeUrl(component)
+        self.timeout = timeout
+        self.gzip = gzip
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def action(self, action:str, params={}):
+        # ACI action with form encoded parameters, returns the 'responsedata'
+        response = self.session.post(f"{self.url}/a={action}&ResponseFormat=simplejson", data=params, timeout=self.timeout)
+        return response.json().get('autnresponse', {}).get('responsedata', {})
+
+    def command(self, command:str, query={}, data=None, method='POST', safe=''):
+        # index command with url parameters and an optional IDX body (bytes or an iterable of bytes)
+        headers = {'Content-type': 'text/plain; charset=utf-8'}
+        if data != None and self.gzip:
+            data = gzip_chunks([data] if isinstance(data, (bytes, bytearray)) else data)
+            headers['Content-Encoding'] = 'gzip'
+        response = self.session.request(method, f"{self.url}/{command}?{urllib.parse.urlencode(query, safe=safe)}", data=data, headers=headers, timeout=self.timeout)
+        return response.text.strip()
+
+    def close(self):
+        self.session.close()
+
 class Service:
 
     def __init__(self, logging, config): 
         self.logging = logging
         self.config = config.get('idol').copy()
+        self.dah = AciClient(self.config.get('dah'), self.config.get('poolsize', 10), self.config.get('timeout', 60))
+        self.dih = AciClient(self.config.get('dih'), self.config.get('poolsize', 10), self.config.get('timeout', 60), self.config.get('gzip', False))
         self.lock = threading.Lock()
+        self.queue_cond = threading.Condition(self.lock)
         self.index_queues = {}
+        self.replace_queues = {} # query uuid -> (first update time, query, {(reference, field): value})
+        self.queue_stats = { 'docs': 0, 'bytes': 0, 'replaces': 0, 'flushes': 0, 'flushed_docs': 0, 'errors': 0, 'last_flush_secs': 0.0, 'avg_flush_secs': 0.0 }
+        self.flush_requested = False
+        self.flushing = True
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.get('threads', 2), thread_name_prefix='IdolPool')
-        self.executor.submit(self.init_batch_queue)
+        # dedicated flusher thread, posting never takes a thread from the pool that fills the queue
+        self.flusher = threading.Thread(target=self.handle_batch_queue, name='IdolFlusher', daemon=True)
+        self.flusher.start()
+        atexit.register(self.shutdown)
 
     def index_into_idol(self, documents, query):
-        self.executor.submit(self._index_into_idol, documents, query)
+        # queued on the caller thread, a full queue slows the caller down and the pool stays free for queries
+        return self._index_into_idol(documents, query)
 
     @retry(wait_fixed=1000, stop_max_delay=10000)
     def _index_into_idol(self, documents, query):
-        index_data = ''
-        for _d in documents:
-            fields = _d.get('fields', [])
-            content = _d.get('drecontent', '')
-            DOCUMENTS = _d.get('content',{}).get('DOCUMENT',[])
-            for DOC in DOCUMENTS:
-                for key in DOC:
-                    if key == 'DRECONTENT':
-                        for value in DOC[key]:
-                            content += value
-                    else:
-                        for value in DOC[key]:
-                            fields.append((key, value))
-
-            index_data += '\n'.join([
-            f"#DREREFERENCE {_d.get('reference')}"] + 
-            [f"#DREFIELD {_f[0]}=\"{_f[1]}\"" for _f in fields] +
-            [f"#DRECONTENT",
-            f"{content}",
-            "#DREENDDOC\n\n"])
+        # returns a future that completes when the documents are posted, or fails with the post error
+        # the batch is materialized only once, already encoded
+        index_data = bytearray()
+        for chunk in write_idx(documents):
+            index_data += chunk
         # add to queue
         _query = CaseInsensitiveDict(query)
         if _query.get('priority', 0) >= 100: # bypass queue
-            self.post_index_data(_query, [(None, _query, index_data, len(documents))])
-        else:
-            self.add_into_batch_queue(_query, index_data, len(documents))
+            posted = concurrent.futures.Future()
+            self.post_index_data(_query, [(None, _query, index_data, len(documents), posted)])
+            posted.set_result({ 'indexed': len(documents) })
+            return posted
+        return self.add_into_batch_queue(_query, index_data, len(documents))
+
+    def write(self, documents, dbname:str, **query):
+        # sink interface: queued for the flusher by the caller thread (a full queue blocks it), the future completes once posted
+        documents = [doc if 'reference' in doc else util.elasticToIdol(doc, dbname) for doc in documents]
+        return self._index_into_idol(documents, dict({ 'DREDbName': dbname, 'KillDuplicates': 'REFERENCE', 'CreateDatabase': True, 'KeepExisting': False, 'Priority': 0 }, **query))
+
+    def delete(self, references:list, dbname:str):
+        return self.remove_documents([str(_r) for _r in references], dbname).result()
 
     def set_field_value(self, references, field, value, query={}):
-        self.executor.submit(self._set_field_value, references, field, value, query)
-
-    def _set_field_value(self, references, field, value, query={}):
-        index_data = ''
-        for reference in references:
-            index_data += '\n'.join([
-                f"#DREDOCREF {reference}",
-                f"#DREFIELDNAME {field}",
-                f"#DREFIELDVALUE {value}"])
-        index_data += "\n#DREENDDATAREFERENCE\n\n"
-        resp = requests.post(f"{util.makeUrl(self.config.get('dih'))}/DREREPLACE?{urllib.parse.urlencode(query)}", data=index_data.encode('utf-8'), headers={'Content-type': 'text/plain; charset=utf-8'}, verify=False).text.strip()
-        self.logging.info(f"set_field_value: {resp}")
+        # coalesced per database, the flusher sends them as batched DREREPLACE bodies
+        with self.queue_cond:
+            query_uuid = util.hashDict(query)
+            if query_uuid not in self.replace_queues:
+                self.replace_queues[query_uuid] = (time.time(), dict(query), {})
+            updates = self.replace_queues[query_uuid][2]
+            for reference in references:
+                if (reference, field) not in updates: self.queue_stats['replaces'] += 1
+                updates[(reference, field)] = value # last value wins
+            self.queue_cond.notify_all()
+
+    def _set_field_values(self, query, updates):
+        # updates is a list of (reference, field, value)
+        index_data = ''.join([f"#DREDOCREF {reference}\n#DREFIELDNAME {field}\n#DREFIELDVALUE {idx_line(value)}\n" for reference, field, value in updates])
+        index_data += "#DREENDDATAREFERENCE\n\n"
+        resp = self.dih.command('DREREPLACE', query, index_data.encode('utf-8'))
+        self.logging.info(f"set_field_value [updates: {len(updates)}, resp: {resp}]")
+        return resp
 
     @retry(wait_fixed=2000, stop_max_delay=60000)
     def post_index_data(self, query, docs=[]):
-        try:
-            batchsize = sum([_d[3] for _d in docs])
-            index_data = '\n'.join([_d[2] for _d in docs]) + "\n#DREENDDATAREFERENCE\n\n"
-            resp = requests.post(f"{util.makeUrl(self.config.get('dih'))}/DREADDDATA?{urllib.parse.urlencode(query)}", data=index_data.encode('utf-8'), headers={'Content-type': 'text/plain; charset=utf-8'}, verify=False).text.strip()
-            self.logging.info(f"Batch sent [docs:{batchsize}, resp:{resp}, pri:{query.get('priority',0)}]")
-        except Exception as error:
-            self.logging.error(f"post_index_data error: {str(error)}, docs:{len(docs)},  query: {query}")
+        batchsize = sum([_d[3] for _d in docs])
+        # a generator body is sent with chunked transfer encoding, batches are not joined
+        index_data = itertools.chain([_d[2] for _d in docs], [b"\n#DREENDDATAREFERENCE\n\n"])
+        resp = self.dih.command('DREADDDATA', query, index_data)
+        self.logging.info(f"Batch sent [docs:{batchsize}, resp:{resp}, pri:{query.get('priority',0)}]")
 
     def remove_documents(self, references, dbname, priority=0):
-        return self.executor.submit(self._remove_documents, references, dbname, priority)
+        # size capped chunks sent concurrently, the future resolves to their responses
+        chunks = reference_chunks(references, self.config.get('refchars', 4000), '+')
+        return self._joined_responses(chunks, [self.executor.submit(self._remove_documents, _c, dbname, priority) for _c in chunks])
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def _remove_documents(self, references, dbname, priority=0):
-        docs = '+'.join(references)
-        resp = requests.post(f"{util.makeUrl(self.config.get('dih'))}/DREDELETEREF?Priority={priority}&DREDbName={dbname}&Docs={docs}", headers={'Content-type': 'text/plain; charset=utf-8'}, verify=False).text.strip()
+        resp = self.dih.command('DREDELETEREF', {'Priority': priority, 'DREDbName': dbname, 'Docs': '+'.join(references)}, safe='+')
         self.logging.info(f"Removed refs {len(references)} in {dbname}, resp: {resp}")
         return resp
 
     def move_to_database(self, source_dbs, target_db, refers=[]):
-        return self.executor.submit(self._move_to_database, source_dbs, target_db, refers).result()
+        # size capped chunks sent concurrently, returns their responses
+        chunks = reference_chunks(refers, self.config.get('refchars', 4000), ',') if len(refers) > 0 else [refers]
+        return self._joined_responses(chunks, [self.executor.submit(self._move_to_database, source_dbs, target_db, _c) for _c in chunks]).result()
+
+    def _joined_responses(self, chunks, futures):
+        # one future for all chunks, resolves to the responses one per line, or fails with the first chunk error
+        joined = concurrent.futures.Future()
+        pending = [len(futures)]
+        lock = threading.Lock()
+        def chunk_done(_f):
+            with lock:
+                pending[0] -= 1
+                if pending[0] > 0: return
+            errors = [_f.exception() for _f in futures if _f.exception() != None]
+            for chunk, _f in zip(chunks, futures):
+                if _f.exception() != None: self.logging.error(f"chunk of {len(chunk)} references failed: {str(_f.exception())}")
+            if len(errors) > 0: joined.set_exception(errors[0])
+            else: joined.set_result('\n'.join([_f.result() for _f in futures]))
+        if len(futures) == 0: joined.set_result('')
+        for _f in futures: _f.add_done_callback(chunk_done)
+        return joined
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def _move_to_database(self, source_dbs, target_db, refers):
@@ -101,7 +235,7 @@ class Service:
             'CreateDatabase': True,
             'Delete' : True
         }
-        resp = requests.get(f"{util.makeUrl(self.config.get('dih'))}/DREEXPORTREMOTE?{urllib.parse.urlencode(query)}", headers={'Content-type': 'text/plain; charset=utf-8'}, verify=False).text.strip()
+        resp = self.dih.command('DREEXPORTREMOTE', query, method='GET')
         self.logging.info(f"Moved docs: {len(refers)}, resp: [{resp}]")
         return resp
 
@@ -110,41 +244,82 @@ class Service:
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def _suggest_on_text(self, query): 
-        response = requests.post(f"{util.makeUrl(self.config.get('dah'))}/a=SuggestOnText&ResponseFormat=simplejson", data=util.aciQuery(query), verify=False)    
-        return response.json().get('autnresponse', {}).get('responsedata', {}).get('hit', [])
+        return self.dah.action('SuggestOnText', util.aciQuery(query)).get('hit', [])
 
     def query(self, query={}):    
         return self.executor.submit(self._query, query).result()
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def _query(self, query): 
-        response = requests.post(f"{util.makeUrl(self.config.get('dah'))}/a=Query&ResponseFormat=simplejson", data=util.aciQuery(query), verify=False)   
-        hits = response.json().get('autnresponse', {}).get('responsedata', {}).get('hit', [])
+        hits = self.dah.action('Query', util.aciQuery(query)).get('hit', [])
         return hits
 
-    def get_statetoken(self, query={}):    
-        return self.executor.submit(self._get_statetoken, query).result()
+    def get_statetoken(self, query={}, maxresults=None, lifetime=None):    
+        return self.executor.submit(self._get_statetoken, query, maxresults, lifetime).result()
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
-    def _get_statetoken(self, query):    
+    def _get_statetoken(self, query, maxresults=None, lifetime=None):    
         params = {
             'Print': 'NoResults',
             'StoreState': True,
             'StoredStateField': 'DREREFERENCE',
-            'StoredStateTokenLifetime': 600
+            'StoredStateTokenLifetime': lifetime or self.config.get('statelifetime', 600)
         }
-        response = requests.post(f"{util.makeUrl(self.config.get('dah'))}/a=Query&ResponseFormat=simplejson", data=util.aciQuery(query, params), verify=False)   
-        statetokeid = response.json().get('autnresponse', {}).get('responsedata', {}).get('state', '')
+        if maxresults != None: params['MaxResults'] = maxresults # only this many hits are stored
+        statetokeid = self.dah.action('Query', util.aciQuery(query, params)).get('state', '')
         self.logging.debug(f"Idol statetoke id: {statetokeid}") 
         return statetokeid
 
+    def iter_state(self, query={}, pagesize=None, fields=None):
+        # stores the result set once, then walks it page by page prefetching the next page
+        pagesize = pagesize or self.config.get('pagesize', 500)
+        # the stored state holds the whole result set and has to outlive the walk over it
+        maxresults = CaseInsensitiveDict(query).get('maxresults') or self.config.get('itermaxresults', 1000000)
+        statetoken = self.get_statetoken(query, maxresults, self.config.get('iterlifetime', 86400))
+        if not statetoken: return
+        params = { 'StateMatchID': statetoken }
+        if fields != None:
+            params.update({ 'Print': 'Fields', 'PrintFields': ','.join(fields) })
+        start = 1
+        page = self.executor.submit(self._query_page, query, params, start, pagesize)
+        while True:
+            hits = page.result()
+            start += pagesize
+            if len(hits) >= pagesize:
+                page = self.executor.submit(self._query_page, query, params, start, pagesize)
+            for hit in hits:
+                yield hit
+            if len(hits) < pagesize: return
+
+    @retry(wait_fixed=10000, stop_max_delay=30000)
+    def _query_page(self, query, params, start, pagesize):
+        # MaxResults is the position of the last result, not a page size
+        params = dict(params, Start=start, MaxResults=start+pagesize-1)
+        return self.dah.action('Query', util.aciQuery(query, params)).get('hit', [])
+
+    def export_to_elastic(self, query, index, indexname:str, fields=None, replace=True, extra={}):
+        # streams the whole Idol result set into an elastic.Service bulk load, 'extra' fields are added to every document
+        documents = (dict(self._hit_document(hit), **extra) for hit in self.iter_state(query, fields=fields))
+        return index.index_documents(documents, indexname, replace)
+
+    def _hit_document(self, hit):
+        DOC = (hit.get('content',{}).get('DOCUMENT') or [{}])[0]
+        return {
+            '_id': hit.get('reference'),
+            'title': hit.get('title', ''),
+            'content': ''.join(DOC.get('DRECONTENT', [])) or hit.get('summary', ''),
+            'date': util.getDocDate(DOC),
+            'url': util.getDocLink(DOC),
+            'src': hit.get('database', ''),
+            'filter': {}
+        }
+
     def get_content(self, query={}):    
         return self.executor.submit(self._get_content, query).result()
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def _get_content(self, query):
-        response = requests.post(f"{util.makeUrl(self.config.get('dah'))}/a=GetContent&ResponseFormat=simplejson", data=util.aciQuery(query), verify=False)   
-        hits = response.json().get('autnresponse', {}).get('responsedata', {}).get('hit', [])
+        hits = self.dah.action('GetContent', util.aciQuery(query)).get('hit', [])
         return hits[0] if len(hits) > 0 else None
 
     def detect_language(self, text):    
@@ -152,8 +327,7 @@ class Service:
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def _detect_language(self, text):    
-        response = requests.post(f"{util.makeUrl(self.config.get('dah'))}/a=DetectLanguage&ResponseFormat=simplejson", data={'Text':text}, verify=False)   
-        response_data = response.json().get('autnresponse', {}).get('responsedata', {})
+        response_data = self.dah.action('DetectLanguage', {'Text':text})
         language = response_data.get('language', util.DFLT_LANGUAGE) if response_data.get('language') != 'UNKNOWN' else util.DFLT_LANGUAGE
         encoding = response_data.get('languageencoding', util.DFLT_ENCODE)
         return { 'language': language , 'encoding': encoding, 'name': language+encoding }
@@ -163,41 +337,128 @@ class Service:
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def _summarize_text(self, query):    
-        response = requests.post(f"{util.makeUrl(self.config.get('dah'))}/a=Summarize&ResponseFormat=simplejson", data=util.aciQuery(query), verify=False)  
-        response_data = response.json().get('autnresponse', {}).get('responsedata', {})
+        response_data = self.dah.action('Summarize', util.aciQuery(query))
         return response_data.get('summary', query.get('text', ''))
 
-    @retry(wait_fixed=10000)
-    def init_batch_queue(self):
-        self.handle_batch_queue()    
-        raise Exception('waiting_for_lock')
-
     def handle_batch_queue(self):
-        self.lock.acquire()
-        try:
-            current_time = time.time()
-            for query_uuid in self.index_queues:
-                batchsize = sum([_d[3] for _d in self.index_queues[query_uuid]])
-                queue_size = len(self.index_queues[query_uuid])
-                queue_time = self.index_queues[query_uuid][queue_size-1][0]
-                if batchsize >= self.config.get('batchsize', 100) or (current_time-queue_time) > 30:
-                    query = self.index_queues[query_uuid][queue_size-1][1]
-                    self.executor.submit(self.post_index_data, query.copy(), self.index_queues[query_uuid].copy())
-                    self.index_queues[query_uuid].clear()
-        finally:
-            self.lock.release()
-            
+        while True:
+            with self.queue_cond:
+                self.queue_cond.wait(timeout=self.config.get('flushinterval', 1))
+                force = self.flush_requested or not self.flushing
+                replaces = self._ready_replaces(force)
+                batches = self._ready_batches(force)
+                if len(batches) == 0 and len(replaces) == 0 and not self.flushing:
+                    return
+            for query, docs in batches:
+                started = time.time()
+                try:
+                    self.post_index_data(query, docs)
+                    self._flushed(docs, time.time()-started)
+                except Exception as error: # retries exhausted, the documents are dropped and their writers told so
+                    self.logging.error(f"post_index_data error: {str(error)}, docs:{sum([_d[3] for _d in docs])}, query: {query}")
+                    self._flushed(docs, time.time()-started, error)
+            for query, updates in replaces:
+                failed = 0
+                for chunk in util.chunks(updates, self.config.get('replacesize', 1000)):
+                    try:
+                        self._set_field_values(query, chunk)
+                    except Exception as error:
+                        self.logging.error(f"set_field_value error: {str(error)}, updates:{len(chunk)}, query: {query}")
+                        failed += len(chunk)
+                with self.queue_cond:
+                    self.queue_stats['replaces'] -= len(updates)
+                    self.queue_stats['errors'] += failed
+                    self.queue_cond.notify_all()
+
+    def _ready_replaces(self, force=False):
+        # called with the queue lock held, pops the field updates over the size or age thresholds
+        replaces = []
+        current_time = time.time()
+        for query_uuid in list(self.replace_queues.keys()):
+            started, query, updates = self.replace_queues[query_uuid]
+            if force or len(updates) >= self.config.get('replacesize', 1000) or current_time - started > self.config.get('batchage', 30):
+                replaces.append((query, [(reference, field, value) for (reference, field), value in updates.items()]))
+                self.replace_queues.pop(query_uuid)
+        return replaces
+
+    def _ready_batches(self, force=False):
+        # called with the queue lock held, pops every queue over the size, bytes or age thresholds
+        batches = []
+        current_time = time.time()
+        force = force or self.queue_stats['bytes'] >= self.config.get('queuebytes', 67108864)
+        for query_uuid, queue in self.index_queues.items():
+            if len(queue) == 0: continue
+            batchsize = sum([_d[3] for _d in queue])
+            batchbytes = sum([len(_d[2]) for _d in queue])
+            queue_age = current_time - queue[0][0]
+            if force or batchsize >= self.config.get('batchsize', 100) or batchbytes >= self.config.get('batchbytes', 8388608) or queue_age > self.config.get('batchage', 30):
+                batches.append((queue[-1][1].copy(), queue.copy()))
+                queue.clear()
+        if len(batches) == 0 and self.queue_stats['docs'] == 0 and self.queue_stats['replaces'] == 0:
+            self.flush_requested = False
+            self.queue_cond.notify_all()
+        return batches
+
+    def _flushed(self, docs, elapsed, error=None):
+        with self.queue_cond:
+            self.queue_stats['docs'] -= sum([_d[3] for _d in docs])
+            self.queue_stats['bytes'] -= sum([len(_d[2]) for _d in docs])
+            if error != None:
+                self.queue_stats['errors'] += sum([_d[3] for _d in docs])
+            else:
+                self.queue_stats['flushes'] += 1
+                self.queue_stats['flushed_docs'] += sum([_d[3] for _d in docs])
+                self.queue_stats['last_flush_secs'] = elapsed
+                self.queue_stats['avg_flush_secs'] = (self.queue_stats['avg_flush_secs']*(self.queue_stats['flushes']-1)+elapsed)/self.queue_stats['flushes']
+            self.queue_cond.notify_all()
+        for _d in docs:
+            if error != None: _d[4].set_exception(error)
+            else: _d[4].set_result({ 'indexed': _d[3] })
+
     def add_into_batch_queue(self, query, index_data, batchsize):
-        self.lock.acquire()
-        try:
+        with self.queue_cond:
+            # backpressure, wait for the flusher while the queued data is over the limit
+            self.queue_cond.notify_all()
+            self.queue_cond.wait_for(lambda: self.queue_stats['bytes'] < self.config.get('queuebytes', 67108864) or not self.flushing)
             query_uuid = util.hashDict(query)
             current_time = time.time()
+            posted = concurrent.futures.Future()
             if query_uuid not in self.index_queues:
-                self.index_queues[query_uuid] = [(current_time, query, index_data, batchsize)]
+                self.index_queues[query_uuid] = [(current_time, query, index_data, batchsize, posted)]
             else:
-                self.index_queues[query_uuid].append((current_time, query, index_data, batchsize))
+                self.index_queues[query_uuid].append((current_time, query, index_data, batchsize, posted))
+            self.queue_stats['docs'] += batchsize
+            self.queue_stats['bytes'] += len(index_data)
+            self.queue_cond.notify_all()
             self.logging.debug(f"add_into_batch_queue: {batchsize}, queue batches: {len(self.index_queues[query_uuid])}")
-        finally:
-            self.lock.release()
+            return posted
+
+    def request_flush(self):
+        # the flusher posts everything queued so far without waiting for its age or size
+        with self.queue_cond:
+            self.flush_requested = True
+            self.queue_cond.notify_all()
+
+    def flush(self, timeout=None):
+        # posts everything queued so far and waits for it, False on timeout or if anything was dropped meanwhile
+        with self.queue_cond:
+            errors = self.queue_stats['errors']
+            self.flush_requested = True
+            self.queue_cond.notify_all()
+            flushed = self.queue_cond.wait_for(lambda: self.queue_stats['docs'] == 0 and self.queue_stats['replaces'] == 0, timeout=timeout)
+            return flushed and self.queue_stats['errors'] == errors
 
+    def queue_status(self):
+        with self.queue_cond:
+            return dict(self.queue_stats, queues=len([_q for _q in self.index_queues.values() if len(_q) > 0]))
 
+    def shutdown(self):
+        with self.queue_cond:
+            if not self.flushing: return
+            self.flushing = False
+            self.queue_cond.notify_all()
+        self.flusher.join()
+        self.executor.shutdown()
+        self.dah.close()
+        self.dih.close()
+        self.logging.info(f"Idol service stopped {self.queue_status()}")
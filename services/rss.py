@@ -1,37 +1,210 @@
 
+import os
 import re 
+import time
 import uuid 
+import queue
 import random
+import hashlib
 import logging
 import datetime
+import requests
+import requests.adapters
 import feedparser
+import threading
+import urllib.parse
+import asyncio
 import concurrent.futures
+import pymongo
 from retrying import retry
-from requests.structures import CaseInsensitiveDict
 
 from services.elastic import Service as elasticService
+from services.filters import Matcher
+from services.seen import SeenSet
+import services.sinks as sinks
 import services.utils as util
 
+USER_AGENT = 'index-flow rss crawler'
+FEED_UNCHANGED = 'unchanged'
+STAGE_END = None
+
+class Stage:
+
+    # pipeline stage: 'workers' threads apply 'handler' to the jobs from 'inbox' and pass them to 'outbox'
+    def __init__(self, logging, name, workers, handler, inbox, outbox):
+        self.logging = logging
+        self.name = name
+        self.handler = handler
+        self.inbox = inbox
+        self.outbox = outbox
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.started = time.time()
+        self.threads = [threading.Thread(target=self.run, name=f"Rss{name.capitalize()}_{i}", daemon=True) for i in range(max(workers, 1))]
+        for _t in self.threads: _t.start()
+
+    def run(self):
+        while True:
+            job = self.inbox.get()
+            if job is STAGE_END: return
+            started = time.time()
+            if job.get('result', None) == None: # failed or finished jobs just flow through
+                try:
+                    self.handler(job)
+                except Exception as error:
+                    self.logging.error(f"RSS_URL: {job['url']} | {self.name}: {str(error)}")
+                    job['result'] = { 'url': job['url'], 'error': str(error) }
+            with self.lock:
+                self.items += 1
+                self.busy += time.time() - started
+            self.outbox.put(job)
+
+    def finish(self):
+        for _t in self.threads: self.inbox.put(STAGE_END)
+        for _t in self.threads: _t.join()
+        elapsed = time.time() - self.started
+        return { 'workers': len(self.threads), 'feeds': self.items, 'busy_secs': round(self.busy, 3), 'feeds_per_sec': round(self.items/elapsed, 3) if elapsed > 0 else 0 }
+
+class AsyncFetchStage:
+
+    # fetch stage running on one asyncio loop: 'concurrency' requests overall, at most 'hostconnections'
+    # per host and 'hostdelay' seconds between request starts on the same host
+    def __init__(self, logging, service, inbox, outbox, concurrency=100, hostconnections=2, hostdelay=1.0, timeout=30):
+        import aiohttp # only this fetch mode needs it, a missing package fails here rather than on the loop thread
+        self.aiohttp = aiohttp
+        self.logging = logging
+        self.name = 'fetch'
+        self.service = service
+        self.inbox = inbox
+        self.outbox = outbox
+        self.concurrency = concurrency
+        self.hostconnections = hostconnections
+        self.hostdelay = hostdelay
+        self.timeout = timeout
+        self.hosts = {}
+        self.items = 0
+        self.busy = 0.0
+        self.started = time.time()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.crawl(),), name='RssAsyncFetch', daemon=True)
+        self.thread.start()
+
+    async def crawl(self):
+        loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        connector = self.aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.hostconnections)
+        async with self.aiohttp.ClientSession(connector=connector, timeout=self.aiohttp.ClientTimeout(total=self.timeout), headers={ 'User-Agent': USER_AGENT }) as session:
+            tasks = set()
+            while True:
+                job = await loop.run_in_executor(None, self.inbox.get)
+                if job is STAGE_END: break
+                task = asyncio.ensure_future(self.fetch(session, job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0: await asyncio.gather(*tasks)
+
+    async def fetch(self, session, job):
+        loop = asyncio.get_running_loop()
+        host = self.hosts.setdefault(urllib.parse.urlsplit(job['url']).hostname, { 'slots': asyncio.Semaphore(self.hostconnections), 'next': 0 })
+        async with host['slots']:
+            # politeness delay, a waiting feed holds only its host slot, not a global one
+            start = max(loop.time(), host['next'])
+            host['next'] = start + self.hostdelay
+            await asyncio.sleep(start - loop.time())
+            started = time.time()
+            try:
+                job['raw'] = await self.get_feed(session, job['url'])
+            except Exception as error:
+                self.logging.error(f"RSS_URL: {job['url']} | {self.name}: {str(error) or type(error).__name__}")
+                job['result'] = { 'url': job['url'], 'error': str(error) or type(error).__name__ }
+            self.items += 1
+            self.busy += time.time() - started
+        # a full outbox is polled from the loop, blocking puts would pin the default executor threads
+        while True:
+            try:
+                self.outbox.put_nowait(job)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+
+    async def get_feed(self, session, feed_url, retries=3, wait=10):
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(None, self.service.get_feed_state, feed_url)
+        for attempt in range(retries):
+            try:
+                # a global slot is held for each attempt only, the wait before a retry frees it
+                async with self.slots:
+                    async with session.get(feed_url, headers=self.service.conditional_headers(state)) as response:
+                        if response.status != 304: response.raise_for_status()
+                        content = await response.read()
+                        return self.service.feed_response(state, response.status, content, response.headers, str(response.url))
+            except Exception:
+                if attempt+1 >= retries: raise
+                await asyncio.sleep(wait)
+
+    def finish(self):
+        self.inbox.put(STAGE_END)
+        self.thread.join()
+        elapsed = time.time() - self.started
+        return { 'workers': self.concurrency, 'hosts': len(self.hosts), 'feeds': self.items, 'busy_secs': round(self.busy, 3), 'feeds_per_sec': round(self.items/elapsed, 3) if elapsed > 0 else 0 }
+
 class Service:
 
-    def __init__(self, logging, task_cfg, index:elasticService): 
+    def __init__(self, logging, task_cfg, index:elasticService, mongo_feeds=None, sink_services=None): 
         self.logging = logging 
         self.task_cfg = task_cfg
         self.index = index 
+        self.sink_services = sink_services or { 'elastic': index }
+        self.sink = None
+        self.mongo_feeds = mongo_feeds # per task feed list and state: cache headers, content hash and polling schedule
+        self.feeds_state = {}
+        self.task_id = str(self.task_cfg.get('_id', self.task_cfg.get('id')))
         self.re_http_url = re.compile(r'^.*(https?://.+)$', re.IGNORECASE)   
         self.numthreads = self.task_cfg['params'].get('threads',2)
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.numthreads, thread_name_prefix='RssPool')
-        self.statistics = { 'threads': self.numthreads, 'feeds': 0, 'errors': 0, 'scanned': 0, 'indexed': 0 }
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=self.numthreads))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=self.numthreads))
+        self.matcher = None
+        if self.task_cfg['params'].get('filters_idx', None): # local filter agents instead of the remote percolator
+            self.matcher = Matcher(self.logging).load_idx(self.task_cfg['params']['filters_idx'])
+        self.seen = None
+        if self.task_cfg['params'].get('seendir', None): # ids of entries already ingested by this task
+            self.seen = SeenSet(os.path.join(self.task_cfg['params']['seendir'], f"{self.task_id}.seen"))
+        self.statistics = { 'threads': self.numthreads, 'feeds': 0, 'errors': 0, 'scanned': 0, 'seen': 0, 'indexed': 0, 'skipped': 0, 'unchanged': 0 }
 
     def result(self):
         self.executor.shutdown()
+        self.session.close()
         return self.statistics
 
     def index_feeds(self, max_feeds=0):
         return self.executor.submit(self._index_feeds, max_feeds).result()
         
     def _index_feeds(self, max_feeds=0):
-        filename = self.task_cfg['params'].get('feeds', 'data/feeds') # TODO salvar/ler lista de feeds no mongodb
+        feeds_urls = self.read_feeds_file()
+        if self.mongo_feeds != None:
+            # the feeds file only seeds the collection, only feeds due are crawled, most overdue first
+            self.add_feeds(feeds_urls)
+            self.feeds_state = { _f['url']: _f for _f in self.due_feeds(max_feeds) }
+            feeds_urls = list(self.feeds_state.keys())
+        random.shuffle(feeds_urls) ## shuffle to avoid flood same domain with all threads at same time
+        if max_feeds <= 0: max_feeds = len(feeds_urls)
+        feeds_urls = feeds_urls[:max_feeds]
+        self.logging.info(f"RSS indextask '{self.task_cfg.get('name')}': Crawling {len(feeds_urls)} urls using {self.task_cfg['params'].get('fetchmode', 'threads')} fetch mode")
+        self.statistics.update({'feeds': len(feeds_urls)})
+        if len(feeds_urls) == 0: return self.statistics
+       
+        self.index.rollover(self.task_cfg['user']['indices']['indexdata'])
+        self.reconcile_seen()
+        if self.task_cfg['params'].get('bulkload', False):
+            with self.index.bulk_load(self.task_cfg['user']['indices']['indexdata']):
+                return self._crawl_feeds(feeds_urls)
+        return self._crawl_feeds(feeds_urls)
+
+    def read_feeds_file(self):
+        filename = self.task_cfg['params'].get('feeds', 'data/feeds')
+        if self.mongo_feeds != None and not os.path.isfile(filename): return []
         feeds_file = open(filename, 'r') 
         Lines = feeds_file.readlines() 
         feeds_urls = set()  ## a set assures to no have duplicated url's
@@ -40,87 +213,218 @@ class Service:
             if self.re_http_url.match(_url):
                 feeds_urls.add(_url)
         feeds_file.close()
-        feeds_urls = list(feeds_urls)
-        random.shuffle(feeds_urls) ## shuffle to avoid flood same domain with all threads at same time
-        if max_feeds <= 0: max_feeds = len(feeds_urls)
-        feeds_urls = feeds_urls[:max_feeds]
-        self.logging.info(f"RSS indextask '{self.task_cfg.get('name')}': Crawling {len(feeds_urls)} urls using {self.numthreads} threads")
-        self.statistics.update({'feeds': len(feeds_urls)})
-       
-        index_threads = []
+        return list(feeds_urls)
+
+    def reconcile_seen(self):
+        # periodically the seen set is rebuilt from the ids this task has in the index
+        if self.seen == None or time.time() - self.seen.reconciled < self.task_cfg['params'].get('seenreconcile', 86400): return
+        # only elastic can be read back, a task writing elsewhere keeps its seen set as it is
+        task_sinks = self.task_cfg['params'].get('sinks') or { 'elastic': None }
+        if 'elastic' not in task_sinks: return
+        try:
+            hits = self.index.iter_query({ 'query': { 'term': { 'task_id': self.task_id } } }, task_sinks['elastic'] or self.task_cfg['user']['indices']['indexdata'], fields=False)
+            self.seen.reconcile([hit['id'] for hit in hits])
+            self.seen.save()
+            self.logging.info(f"RSS indextask '{self.task_cfg.get('name')}': seen entries reconciled with the index: {len(self.seen)}")
+        except Exception as error:
+            self.logging.error(f"RSS indextask '{self.task_cfg.get('name')}': seen entries reconcile: {str(error)}")
+
+    def add_feeds(self, feeds_urls):
+        if len(feeds_urls) == 0: return
+        updates = [pymongo.UpdateOne({ 'task_id': self.task_id, 'url': _url }, { '$setOnInsert': { 'nextfetch': 0 } }, upsert=True) for _url in feeds_urls]
+        self.mongo_feeds.bulk_write(updates, ordered=False)
+
+    def due_feeds(self, max_feeds=0):
+        now = int(datetime.datetime.now().timestamp())
+        query = { 'task_id': self.task_id, '$or': [{ 'nextfetch': { '$lte': now } }, { 'nextfetch': { '$exists': False } }] }
+        return list(self.mongo_feeds.find(query).sort('nextfetch', pymongo.ASCENDING).limit(max(max_feeds, 0)))
+
+    def feed_schedule(self, state, result, now):
+        # next fetch adapts to the observed publish rate (new items per hour, moving average),
+        # failing feeds back off exponentially
+        params = self.task_cfg['params']
+        mininterval = params.get('mininterval', 300)
+        maxinterval = params.get('maxinterval', 86400)
+        if result.get('error') != None:
+            failures = state.get('failures', 0) + 1
+            return { 'failures': failures, 'lasterror': result['error'], 'nextfetch': now + min(maxinterval, mininterval * 2**failures) }
+        elapsed = max(now - state.get('lastfetch', now - state.get('interval', mininterval)), 1)
+        new_items = result.get('new', result.get('indexed', 0))
+        rate = 0.5*state.get('rate', 0) + 0.5*new_items*3600/elapsed
+        interval = int(min(maxinterval, max(mininterval, 3600/rate))) if rate > 0 else maxinterval
+        update = { 'failures': 0, 'rate': rate, 'interval': interval, 'lastfetch': now, 'nextfetch': now + interval }
+        if new_items > 0: update['lastnew'] = now
+        return update
+
+    def schedule_feeds(self, results):
+        if self.mongo_feeds == None or len(results) == 0: return
+        now = int(datetime.datetime.now().timestamp())
+        updates = [pymongo.UpdateOne({ 'task_id': self.task_id, 'url': _r['url'] }, { '$set': self.feed_schedule(self.feeds_state.get(_r['url'], {}), _r, now) }) for _r in results]
+        self.mongo_feeds.bulk_write(updates, ordered=False)
+
+    def _crawl_feeds(self, feeds_urls):
+        # fetch -> parse -> index stages, each with its own workers, connected by bounded queues
+        params = self.task_cfg['params']
+        self.sink = sinks.open_sink(self.logging, params, self.sink_services, { 'elastic': None },
+            { 'elastic': self.task_cfg['user']['indices']['indexdata'], 'idol': params.get('database', 'RSS') }, { 'elastic': { 'replace': False } })
+        queuesize = params.get('queuesize', self.numthreads*2)
+        urls, fetched, parsed, results = queue.Queue(), queue.Queue(maxsize=queuesize), queue.Queue(maxsize=queuesize), queue.Queue()
+        if params.get('fetchmode', 'threads') == 'async':
+            fetch = AsyncFetchStage(self.logging, self, urls, fetched, params.get('concurrency', 100), params.get('hostconnections', 2), params.get('hostdelay', 1.0), params.get('timeout', 30))
+        else:
+            fetch = Stage(self.logging, 'fetch', self.numthreads, self.fetch_feed, urls, fetched)
+        stages = [
+            fetch,
+            Stage(self.logging, 'parse', params.get('parse_threads', 2), self.parse_feed, fetched, parsed),
+            Stage(self.logging, 'index', params.get('index_threads', 2), self.index_feed, parsed, results)
+        ]
         for _url in feeds_urls:
-            index_threads.append(
-                self.executor.submit(self.index_feed, _url, 
-                    self.executor.submit(self.get_feed_from_url, _url).result())) 
+            urls.put({ 'url': _url })
+        stages_stats = {}
+        for stage in stages: # upstream stages finish first, so every job reaches the results queue
+            stages_stats[stage.name] = stage.finish()
+        self.sink.flush()
+        sinks_stats = self.sink.close()
 
         total_errors_docs = 0
         total_scanned_docs = 0
-        total_indexed_docs = 0
-        for _t in index_threads:
-            result =  _t.result()
+        total_seen_docs = 0
+        total_unchanged_feeds = 0
+        feeds_results = []
+        while not results.empty():
+            job = results.get()
+            result = job.get('result', {})
+            if 'write' in job and not job['write'].ok(): # scheduled as failed, so it is fetched again soon
+                result['error'] = f"{job['write'].errors()} documents not written"
             self.logging.debug(f"{result}")
+            feeds_results.append(result)
             total_errors_docs += result.get('errors', 1)
             total_scanned_docs += result.get('scanned', 0)
-            total_indexed_docs += result.get('indexed', 0)
-            self.statistics.update({'scanned': total_scanned_docs, 'indexed': total_indexed_docs, 'errors': total_errors_docs })
+            total_seen_docs += result.get('seen', 0)
+            total_unchanged_feeds += result.get('unchanged', 0)
+            # feed state and seen entries are saved only once the sinks confirmed the feed documents, otherwise the feed is fetched again
+            if result.get('error') == None and 'docs' in job:
+                self.save_feed_state(job['url'], job['cache'])
+                if self.seen != None: self.seen.add([doc['_id'] for doc in job['docs']]) # filtered out entries are seen too
+        primary = list(sinks_stats.values())[0]
+        total_errors_docs += sum([_s.get('errors', 0) for _s in sinks_stats.values()])
+        self.statistics.update({'scanned': total_scanned_docs, 'seen': total_seen_docs, 'indexed': primary.get('indexed', 0), 'skipped': primary.get('skipped', 0), 'unchanged': total_unchanged_feeds, 'errors': total_errors_docs, 'stages': stages_stats, 'sinks': sinks_stats })
+        self.schedule_feeds(feeds_results)
+        if self.seen != None: self.seen.save()
         
         self.logging.info(f"RSS indextask '{self.task_cfg.get('name')}' finished: {self.statistics}")
         return self.statistics
 
-    def index_feed(self, feed_url, feed):
-        try:
-            if len((feed or {}).get('entries',[])) <= 0:
-                raise Exception('no feed entries')
-            return self._index_feed(feed_url, feed)
-        except Exception as error:
-            self.logging.error(f"RSS_URL: {feed_url} | {str(error)}")
-            return { 'url': feed_url, 'error': str(error) }
+    def fetch_feed(self, job):
+        job['raw'] = self.get_feed_from_url(job['url'])
+
+    def parse_feed(self, job):
+        if job['raw'] == FEED_UNCHANGED:
+            job['result'] = { 'url': job['url'], 'unchanged': 1, 'errors': 0 }
+            return
+        content, headers, cache = job.pop('raw')
+        feed = feedparser.parse(content, response_headers=headers)
+        if len(feed.get('entries',[])) <= 0:
+            raise Exception('no feed entries')
+        job['cache'] = cache
+        job['scanned'] = len(feed.entries)
+        job['docs'], job['errors'], job['seen'] = self.feed_documents(job['url'], feed)
+
+    def index_feed(self, job):
+        docs = self.filter_documents(job['docs'])
+        # batched by the task sinks, entries already in the elastic index come back as 'skipped'
+        job['write'] = self.sink.write(docs)
+        job['result'] = { 'url': job['url'], 'scanned': job['scanned'], 'seen': job['seen'], 'new': len(job['docs']), 'written': len(docs), 'errors': job['errors'] }
 
-    def _index_feed(self, feed_url, feed):      
+    def feed_documents(self, feed_url, feed):
         total_errors_docs = 0
-        total_indexed_docs = 0
+        total_seen_docs = 0
+        entries = []
         for _e in feed.get('entries',[]):
             link = None
             try:
-                indices = self.task_cfg['user']['indices']
                 link = _e.get('link', _e.get('href', _e.get('url', _e.get('links', [{'href':feed_url}])[0].get('href', feed_url) )))
                 if self.re_http_url.match(link): link = self.re_http_url.search(link).group(1)
                 _id = uuid.uuid3(uuid.NAMESPACE_URL, link)
+                if self.seen != None and _id in self.seen: # known entry, dropped before any cleaning or filtering
+                    total_seen_docs += 1
+                    continue
                 date = _e.get('published', _e.get('timestamp', _e.get('date')))
                 content = _e.get('summary', _e.get('description', _e.get('text', _e.get('content', _e.get('paragraph', None)))))
-                title = util.cleanText(_e.get('title', _e.get('titulo', _e.get('headline', content or ''))))
-                if content == None and title != None: content = title
-                else: content = util.cleanText(content)
-                if len(title) > 100: title = title[:100].rsplit(' ', 1)[0]+'...' # truncate title
-            
-                filterHits = []
-                if self.task_cfg.get('filters', False): # TODO ser possivel escolher quais filtros aplicar
-                    filterHits = self.index.search_filters(content, indices['filters'])
-
-                if not self.task_cfg.get('filters', False) or len(filterHits) > 0:
-                    doc = {
-                        '_id': _id,
-                        'title': title,
-                        'content': content,
-                        'date': date,
-                        'url': link,
-                        'src': feed_url,
-                        'indextask': self.task_cfg.get('name'),
-                        'task_id': str(self.task_cfg.get('_id', self.task_cfg.get('id'))),
-                        'filter': {}
-                    }
-                    for hit in filterHits:
-                        doc['filter'][hit.get('id')] = hit.get('title')
-                    total_indexed_docs += self.index.index_document(doc, indices['indexdata'], False)
+                title = _e.get('title', _e.get('titulo', _e.get('headline', content or '')))
+                if not isinstance(title, str) or not isinstance(content, (str, type(None))): # e.g. a feedparser 'content' list
+                    raise TypeError(f"entry text is not a string: title {type(title).__name__}, content {type(content).__name__}")
+                entries.append((_id, link, date, title, content))
             except Exception as error:
                 self.logging.error(f"feed entry: {link} -> error: {str(error)}")
                 total_errors_docs += 1
 
-        return { 'url': feed_url, 'scanned': len(feed.entries), 'indexed': total_indexed_docs, 'errors': total_errors_docs }
+        # titles and contents of the whole feed are cleaned in one batch
+        texts = util.cleanTexts([text for _e in entries for text in (_e[3], _e[4])], self.task_cfg['params'].get('cleanprocesses', 0))
+        docs = []
+        for i, (_id, link, date, title, content) in enumerate(entries):
+            title = texts[i*2]
+            content = title if content == None else texts[i*2+1]
+            if len(title) > 100: title = title[:100].rsplit(' ', 1)[0]+'...' # truncate title
+            docs.append({
+                '_id': _id,
+                'title': title,
+                'content': content,
+                'date': date,
+                'url': link,
+                'src': feed_url,
+                'indextask': self.task_cfg.get('name'),
+                'task_id': self.task_id,
+                'filter': {}
+            })
+        return docs, total_errors_docs, total_seen_docs
+
+    def filter_documents(self, docs):
+        if self.matcher != None:
+            for doc in docs:
+                doc['filter'] = self.matcher.match(doc['content'])
+            return [doc for doc in docs if len(doc['filter']) > 0]
+        if self.task_cfg.get('filters', False) and len(docs) > 0: # TODO ser possivel escolher quais filtros aplicar
+            # percolate the whole feed in one request, keep only entries matching some filter
+            filterHits = self.index.search_filters_batch([doc['content'] for doc in docs], self.task_cfg['user']['indices']['filters'])
+            for doc, hits in zip(docs, filterHits):
+                for hit in hits:
+                    doc['filter'][hit.get('id')] = hit.get('title')
+            return [doc for doc in docs if len(doc['filter']) > 0]
+        return docs
 
     @retry(wait_fixed=10000, stop_max_delay=30000)
     def get_feed_from_url(self, feed_url):
-        return feedparser.parse(feed_url)
+        state = self.get_feed_state(feed_url)
+        response = self.session.get(feed_url, headers=self.conditional_headers(state), timeout=self.task_cfg['params'].get('timeout', 30))
+        if response.status_code != 304: response.raise_for_status()
+        return self.feed_response(state, response.status_code, response.content, response.headers, response.url)
+
+    def conditional_headers(self, state):
+        headers = { 'User-Agent': USER_AGENT }
+        if state.get('etag'): headers['If-None-Match'] = state['etag']
+        if state.get('modified'): headers['If-Modified-Since'] = state['modified']
+        return headers
+
+    def feed_response(self, state, status_code, content, headers, url):
+        # conditional GET, not modified (304) or same content feeds are not parsed again
+        if status_code == 304:
+            return FEED_UNCHANGED
+        content_hash = hashlib.sha1(content).hexdigest()
+        if content_hash == state.get('hash'):
+            return FEED_UNCHANGED
+        response_headers = { k.lower(): v for k, v in headers.items() }
+        response_headers.setdefault('content-location', url)
+        return content, response_headers, { 'etag': response_headers.get('etag'), 'modified': response_headers.get('last-modified'), 'hash': content_hash }
+
+    def get_feed_state(self, feed_url):
+        if self.mongo_feeds == None: return {}
+        return self.mongo_feeds.find_one({ 'task_id': self.task_id, 'url': feed_url }) or {}
+
+    def save_feed_state(self, feed_url, state:dict):
+        # saved only after the feed is indexed, so a failed run fetches it again
+        if self.mongo_feeds == None: return
+        self.mongo_feeds.update_one({ 'task_id': self.task_id, 'url': feed_url }, { '$set': state }, upsert=True)
 
 
 
@@ -18,7 +18,7 @@ task_timeout_sec=3600
 
 class Service:
     
-    def __init__(self, logging, config, mongodb, doccano:doccanoService, index:elasticService, spacynlp:spacynlpService): 
+    def __init__(self, logging, config, mongodb, doccano:doccanoService, index:elasticService, spacynlp:spacynlpService, idol=None): 
         self.maxtasks = config['service']['maxtasks']
         self.running = False
         self.executing_tasks = {}
@@ -27,9 +27,14 @@ class Service:
         self.doccano = doccano
         self.index = index 
         self.spacynlp = spacynlp
+        self.idol = idol
+        self.sink_services = { 'elastic': index, 'idol': idol } # index sinks the rss/stock tasks can write into
         self.mongo_tasks = mongodb['tasks']
         self.mongo_users = mongodb['users']
         self.mongo_projects = mongodb['projects']
+        self.mongo_feeds = mongodb['feeds']
+        self.mongo_profiles = mongodb['stock_profiles']
+        self.mongo_checkpoints = mongodb['stock_checkpoints']
         self.tasks_defaults = config.get('tasks_defaults',{})
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxtasks+1, thread_name_prefix='Scheduler')
         self.running = self.executor.submit(self.initService).result()
@@ -98,17 +103,26 @@ class Service:
 
             # INDEX TASKS ## TODO ## DEVE SER UM MICROSERVIÇO ????
             if task['type'] == 'rss':  # enduser
-                _rss = rss.Service(self.logging, task, self.index)
+                _rss = rss.Service(self.logging, task, self.index, self.mongo_feeds, self.sink_services)
                 _rss.index_feeds()
                 #task_result = _rss.result()
             
             elif task['type'] == 'stock':  # enduser
-                stockService = stock.Service(self.logging, task, self.index)
-                exchangeCodes = task.get('exchanges', [])
+                stockService = stock.Service(self.logging, task, self.sink_services, self.mongo_profiles, self.mongo_checkpoints)
+                exchangeCodes = task.get('exchanges', task.get('params', {}).get('exchanges', []))
                 if len(exchangeCodes) == 0:
                     exchangeCodes = stockService.list_exchange_codes()
                 stockService.index_stocks_symbols(exchangeCodes)
             
+            elif task['type'] == 'export_from_idol': # enduser
+                # Idol documents into the user index, where doccano imports and model training pick them up
+                if self.idol == None: raise Exception('Idol service is not available')
+                params = task.get('params', {})
+                query = { 'Text': params.get('query_text') or '*', 'DatabaseMatch': params.get('database', '') }
+                stats = self.idol.export_to_elastic(query, self.index, user['indices']['indexdata'], params.get('fields') or None, params.get('replace', False),
+                    { 'indextask': util.getTaskName(task), 'task_id': str(task['_id']) })
+                self.logging.info(f"Exported from Idol '{util.getTaskName(task)}': {stats}")
+
             elif task['type'] == 'import_from_index': # enduser
                 self.doccano.import_from_index(task)
 
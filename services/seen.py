@@ -0,0 +1,59 @@
+import os
+import uuid
+import time
+import bisect
+import threading
+from array import array
+
+# Set of already ingested entry ids, persisted as a sorted array of 64 bit keys
+# file layout (uint64): [reconciled timestamp, key, key, ...], 8 bytes per entry
+
+def entry_key(_id):
+    return int.from_bytes(uuid.UUID(str(_id)).bytes[:8], 'little')
+
+class SeenSet:
+
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.keys = array('Q')
+        self.added = set()
+        self.reconciled = 0
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as seen_file:
+                data = array('Q')
+                data.frombytes(seen_file.read())
+            if len(data) > 0:
+                self.reconciled = data[0]
+                self.keys = data[1:]
+
+    def __len__(self):
+        return len(self.keys) + len(self.added)
+
+    def __contains__(self, _id):
+        key = entry_key(_id)
+        pos = bisect.bisect_left(self.keys, key)
+        return (pos < len(self.keys) and self.keys[pos] == key) or key in self.added
+
+    def add(self, ids):
+        with self.lock:
+            self.added.update([entry_key(_id) for _id in ids])
+
+    def reconcile(self, ids):
+        # replaces the whole set, entries no longer in the index are forgotten
+        with self.lock:
+            self.keys = array('Q', sorted(set([entry_key(_id) for _id in ids])))
+            self.added = set()
+            self.reconciled = int(time.time())
+
+    def save(self):
+        with self.lock:
+            if len(self.added) > 0:
+                self.keys = array('Q', sorted(set(self.keys).union(self.added)))
+                self.added = set()
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+            tmp_filename = f"{self.filename}.tmp"
+            with open(tmp_filename, 'wb') as seen_file:
+                array('Q', [self.reconciled]).tofile(seen_file)
+                self.keys.tofile(seen_file)
+            os.replace(tmp_filename, self.filename)
@@ -0,0 +1,204 @@
+import time
+import queue
+import threading
+import collections
+
+# Index sinks: elastic.Service and idol.Service implement
+#   write(documents, target, **options) -> future with stats once written, request_flush(), flush(timeout) and delete(ids, target)
+# a task writes through a Sink, which fans out to one or more targets, each with its own bounded queue,
+# writer thread and batching, so a slow target only slows its producers once its own queue is full
+
+SINK_END = None
+SINK_SEND = 'send'
+
+class SinkWrite:
+
+    # one Sink.write call, settled once every target confirmed or failed each of its documents
+    def __init__(self, pending):
+        self.cond = threading.Condition()
+        self.pending = pending
+        self.failed = 0
+
+    def settle(self, count, failed=False):
+        with self.cond:
+            self.pending -= count
+            if failed: self.failed += count
+            self.cond.notify_all()
+
+    def wait(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.pending <= 0, timeout=timeout)
+
+    def errors(self):
+        with self.cond:
+            return self.failed
+
+    def ok(self):
+        with self.cond:
+            return self.pending <= 0 and self.failed == 0
+
+
+class SinkTarget:
+
+    def __init__(self, logging, name, service, target, options={}, batchsize=500, queuesize=5000, wait=1.0):
+        self.logging = logging
+        self.name = name
+        self.service = service
+        self.target = target
+        self.options = options
+        self.batchsize = batchsize
+        self.wait = wait
+        self.queue = queue.Queue(maxsize=queuesize)
+        self.lock = threading.Lock()
+        self.put_lock = threading.Lock()
+        self.closed = False
+        self.pending = []
+        self.stats = { 'target': target, 'batches': 0, 'indexed': 0, 'skipped': 0, 'errors': 0, 'blocked_secs': 0.0 }
+        self.thread = threading.Thread(target=self.run, name=f"Sink{name.capitalize()}", daemon=True)
+        self.thread.start()
+
+    def put(self, documents, write:SinkWrite):
+        started = time.time()
+        for i, doc in enumerate(documents):
+            while True:
+                with self.put_lock: # nothing is queued behind the end of a closed target
+                    if self.closed:
+                        self.logging.error(f"Sink {self.name} '{self.target}': closed, {len(documents)-i} documents not written")
+                        write.settle(len(documents)-i, True)
+                        return
+                    try:
+                        self.queue.put((doc, write), timeout=self.wait)
+                        break
+                    except queue.Full:
+                        pass
+        with self.lock:
+            self.stats['blocked_secs'] += time.time() - started
+
+    def run(self):
+        batch = []
+        while True:
+            try:
+                item = self.queue.get(timeout=self.wait if len(batch) > 0 or len(self.pending) > 0 else None)
+            except queue.Empty: # nothing new for a while, send what we have
+                item = SINK_SEND
+            if isinstance(item, tuple):
+                batch.append(item)
+                if len(batch) < self.batchsize: continue
+            if len(batch) > 0:
+                self.send(batch)
+                batch = []
+            if isinstance(item, threading.Event): # flush request
+                self.drain()
+                item.set()
+            elif item is SINK_END:
+                self.drain()
+                return
+            else:
+                self.collect(wait=False)
+
+    def send(self, batch):
+        documents = [doc for doc, _w in batch]
+        writes = collections.Counter([_w for _doc, _w in batch])
+        try:
+            self.pending.append((self.service.write(documents, self.target, **self.options), len(documents), writes))
+        except Exception as error:
+            self.logging.error(f"Sink {self.name} '{self.target}': {str(error)}")
+            self.settle(len(documents), writes, error=error)
+
+    def collect(self, wait=True):
+        # batch results are read here on the writer thread, so once drained every batch is accounted for
+        pending = []
+        for future, size, writes in self.pending:
+            if not wait and not future.done():
+                pending.append((future, size, writes))
+                continue
+            try:
+                stats = future.result()
+            except Exception as error:
+                self.logging.error(f"Sink {self.name} '{self.target}': {str(error)}")
+                self.settle(size, writes, error=error)
+            else:
+                self.settle(size, writes, stats=stats)
+        self.pending = pending
+
+    def settle(self, size, writes, stats={}, error=None):
+        with self.lock:
+            self.stats['batches'] += 1
+            if error != None:
+                self.stats['errors'] += size
+            for key, value in stats.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+        # a batch with any error fails every write with documents in it
+        failed = error != None or stats.get('errors', 0) > 0
+        for write, count in writes.items():
+            write.settle(count, failed)
+
+    def drain(self):
+        # the service is only asked to post what it holds, then just this target's own batches are waited for
+        try:
+            self.service.request_flush()
+        except Exception as error:
+            self.logging.error(f"Sink {self.name} '{self.target}': {str(error)}")
+        self.collect()
+
+    def flush(self, timeout=None):
+        flushed = threading.Event()
+        with self.put_lock:
+            if self.closed: return False
+            self.queue.put(flushed)
+        return flushed.wait(timeout)
+
+    def close(self):
+        with self.put_lock:
+            if self.closed: return
+            self.closed = True
+        self.queue.put(SINK_END)
+        self.thread.join()
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, blocked_secs=round(self.stats['blocked_secs'], 3))
+
+
+class Sink:
+
+    def __init__(self, logging, targets:list):
+        self.logging = logging
+        self.targets = targets
+
+    def write(self, documents):
+        # returns a SinkWrite to wait for and check these documents only, other writes can share the sink
+        write = SinkWrite(len(documents)*len(self.targets))
+        for target in self.targets:
+            target.put(documents, write)
+        return write
+
+    def flush(self, timeout=None):
+        # waits every target to send and confirm what was written so far
+        return all([target.flush(timeout) for target in self.targets])
+
+    def delete(self, ids:list):
+        return { target.name: target.service.delete(ids, target.target) for target in self.targets }
+
+    def errors(self):
+        # errors of every write so far, a sink shared by concurrent jobs checks its own SinkWrite instead
+        return sum([target.status().get('errors', 0) for target in self.targets])
+
+    def status(self):
+        return { target.name: target.status() for target in self.targets }
+
+    def close(self):
+        for target in self.targets:
+            target.close()
+        return self.status()
+
+
+def open_sink(logging, params:dict, services:dict, default_sinks:dict, default_targets:dict, options:dict={}):
+    # services: sink name -> service, params 'sinks' chooses them: { service name: target or null for the default target }
+    targets = []
+    for name, target in (params.get('sinks') or default_sinks).items():
+        if services.get(name) == None:
+            raise Exception(f"Sink '{name}' is not available")
+        targets.append(SinkTarget(logging, name, services[name], target or default_targets.get(name), options.get(name, {}),
+            params.get('sinkbatch', 500), params.get('sinkqueue', 5000), params.get('sinkwait', 1.0)))
+    return Sink(logging, targets)
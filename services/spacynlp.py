@@ -5,6 +5,7 @@ import time
 import json
 import random
 import logging
+import itertools
 import concurrent.futures
 from pathlib import Path
 import spacy
@@ -306,8 +307,8 @@ class Service:
         index_query = proj['index_query']
         indices = proj['indices']      
         train_data = []
-        # parse documents into expected 'spacy' format
-        for hit in self.index.query(index_query, indices):
+        # parse documents into expected 'spacy' format, sampling lazily over the whole result set
+        for hit in util.reservoirSample(self.index.iter_query(index_query, indices, fields=[export_field]), limit):
             hit_data = hit.get(export_field,{})
             self.logging.info(f"hit_data: {hit_data}")
             # trasformar disso:  [{'end_offset': 147, 'label': 5, 'start_offset': 136, 'user': 1}, ... ]
@@ -324,15 +325,14 @@ class Service:
         index_query = proj['index_query']
         indices = proj['indices']      
         train_data = []
-        # parse documents into expected 'spacy' format
-        for hit in self.index.query(index_query, indices):
+        # parse documents into expected 'spacy' format, sampling lazily over the whole result set
+        for hit in util.reservoirSample(self.index.iter_query(index_query, indices, fields=['content', export_field]), limit):
             hit_data = hit.get(export_field,{})
             labels = [proj['labels'][str(_l.get('label'))] for _l in hit_data]
             train_data.append(( (hit['id'],hit['index']) , hit['content'], labels)) 
         
         if len(train_data) >= minhits:
             random.shuffle(train_data)
-            train_data = train_data[-limit:]
             ids, texts, labels = zip(*train_data)
             # list categories (labels) from Doccano
             labels_template = {}
@@ -352,10 +352,11 @@ class Service:
             selected_ids = ids[:split]
             #self.logging.info(f"selected_ids: {selected_ids}")
             curr_time = int(time.time())
-            for _id, _index in selected_ids:
-                _res = self.index.update_fields(_index, _id, { proj['train_ts_field']: curr_time })
-                if (_res or {}).get('result',None) != 'updated':
-                    self.logging.error(f"Error updating index field '{proj['train_ts_field']}' to {curr_time} -> {_res}")
+            for _index, _ids in itertools.groupby(sorted(selected_ids, key=lambda _s: _s[1]), key=lambda _s: _s[1]):
+                _ids = [_id for _id, _ in _ids]
+                _res = self.index.update_by_ids(_index, _ids, { proj['train_ts_field']: curr_time })
+                if _res != len(_ids):
+                    self.logging.error(f"Error updating index field '{proj['train_ts_field']}' to {curr_time} -> {_res} of {len(_ids)} updated in {_index}")
 
             return (texts[:split], cats[:split]), (texts[split:], cats[split:]), list(labels_template.keys())
         return ([], []), ([], []), []
@@ -2,39 +2,111 @@
 
 import re 
 import html
+import time
+import json
+import hashlib
 import logging
+import threading
 import requests
+import requests.adapters
 import datetime
 import concurrent.futures
+import pymongo
 from retrying import retry
 from requests.structures import CaseInsensitiveDict
+import services.utils as util
+import services.sinks as sinks
 filters_fieldprefix = 'FILTERINDEX'
 
+def document_hash(document):
+    # the run DATE is left out, so an unchanged company keeps the same hash
+    fields = [_f for _f in document.get('fields', []) if _f[0] != 'DATE']
+    return hashlib.md5(json.dumps([document.get('drecontent'), fields], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class RateLimiter:
+
+    # token bucket shared by all pool threads: 'rate' calls per second, up to 'burst' calls at once
+    # a 429 halves the rate and pauses the bucket, each success gives back 5% of the quota (AIMD)
+    def __init__(self, rate, burst=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now > self.updated:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+                    self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (self.updated - now) + (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.max_rate/16, self.rate/2)
+            self.tokens = 0
+            self.updated = time.monotonic() + (retry_after or 1/self.rate)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate*0.05)
+
 # https://finnhub.io/docs/api
 class Service:
     
     executor = None
     logging = None
     config = None
-    idol = None
+    sink = None
 
-    def __init__(self, logging, config, idol): 
+    def __init__(self, logging, config, sink_services:dict, mongo_profiles=None, mongo_checkpoints=None): 
         self.logging = logging
         self.config = config.copy()
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.get('threads', 2), thread_name_prefix='StockPool')
-        self.idol = idol 
+        self.params = self.config.get('params', self.config)
+        numthreads = self.params.get('threads', 2)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=numthreads, thread_name_prefix='StockPool')
+        self.profiles_executor = concurrent.futures.ThreadPoolExecutor(max_workers=numthreads, thread_name_prefix='StockProfilePool')
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=numthreads*2))
+        # finnhub quota is per api key, every request of this service goes through the same bucket
+        self.limiter = RateLimiter(self.params.get('ratelimit', 60)/60.0, self.params.get('burst', 5))
+        self.sink_services = sink_services
+        self.mongo_profiles = mongo_profiles # per exchange+symbol profile cache: profile, fetch time and document hash
+        self.mongo_checkpoints = mongo_checkpoints # per task+exchange last indexed symbol, to resume an interrupted run
+        self.task_id = str(self.config.get('_id', self.config.get('id')))
+
+    def finnhub_request(self, path, query={}):
+        url = f"{self.params.get('url')}{path}"
+        query = dict(query, token=self.params.get('api'))
+        headers = {'X-Finnhub-Secret': self.params.get('key')}
+        for _ in range(self.params.get('throttleretries', 8)):
+            self.limiter.acquire()
+            response = self.session.get(url, headers=headers, params=query, timeout=self.params.get('timeout', 30))
+            if response.status_code == 429:
+                retry_after = response.headers.get('Retry-After')
+                self.limiter.throttled(float(retry_after) if retry_after and retry_after.isdigit() else None)
+                self.logging.warning(f"Finnhub: rate limited on '{path}', rate lowered to {self.limiter.rate*60:.1f}/min")
+                continue
+            self.limiter.succeeded()
+            response.raise_for_status() # an error body must not pass for a profile
+            try:
+                return response.json()
+            except Exception as error:
+                self.logging.error(f"{response} - {str(error)}")
+                raise error
+        raise Exception(f"Finnhub: still rate limited on '{path}'")
 
     @retry(wait_fixed=10000, stop_max_delay=70000)
     def get_symbol_profile(self, symbol):
-        url = f"{self.config.get('url')}/stock/profile2"
-        query = {'token':self.config.get('api'), 'symbol':symbol}
-        headers = {'X-Finnhub-Secret': self.config.get('key')}
-        response = requests.request('GET', url, headers=headers, params=query)
-        try:
-            return response.json()
-        except Exception as error:
-            self.logging.error(f"{response} - {str(error)}")
-            raise error
+        return self.finnhub_request('/stock/profile2', {'symbol':symbol})
 
     def list_exchange_codes(self):
         return self.executor.submit(self._list_exchange_codes).result()
@@ -45,87 +117,179 @@ class Service:
     @retry(wait_fixed=10000, stop_max_delay=90000)
     def get_stock_exchanges(self):
         self.logging.info(f"Listing stock exchanges...")
-        url = f"{self.config.get('url')}/stock/exchange"
-        query = {'token':self.config.get('api')}
-        headers = {'X-Finnhub-Secret': self.config.get('key')}
-        response = requests.request('GET', url, headers=headers, params=query)
-        try:
-            return response.json()
-        except Exception as error:
-            self.logging.error(f"{response} - {str(error)}")
-            raise error
+        return self.finnhub_request('/stock/exchange')
 
     def index_stocks_symbols(self, exchanges=['US']):
         self.logging.info(f"==== Starting ====>  STOCK indextask '{self.config.get('name')}'")
+        indices = (self.config.get('user') or {}).get('indices', {})
+        self.sink = sinks.open_sink(self.logging, self.params, self.sink_services, { 'idol': None },
+            { 'idol': self.params.get('database', 'STOCK'), 'elastic': indices.get('indexdata') })
         threads = []
-        for _e in exchanges: 
-            threads.append(self.executor.submit(self.index_stock_symbols, _e))
-        responses = []
-        for _t in threads:
-            _r = _t.result()
-            responses.append(_r)   
-        self.logging.info(f"STOCK indextask '{self.config.get('name')}' completed")
-        return responses
+        try:
+            for _e in exchanges: 
+                threads.append(self.executor.submit(self.index_stock_symbols, _e))
+        finally:
+            concurrent.futures.wait(threads) # every exchange is done with the shared sink before it closes
+            sinks_stats = self.sink.close()
+        self.logging.info(f"STOCK indextask '{self.config.get('name')}' completed {sinks_stats}")
+        return [_t.result() for _t in threads]
             
     @retry(wait_fixed=10000, stop_max_delay=90000)
+    def get_stock_symbols(self, exchange):
+        symbols = self.finnhub_request('/stock/symbol', {'exchange':exchange})
+        if not isinstance(symbols, list) or len(symbols) == 0: # an empty list would delist the whole exchange
+            raise Exception(f"Finnhub: no symbols for '{exchange}': {symbols}")
+        return symbols
+
+    def get_profile(self, symbol):
+        # None on failure, Finnhub answers many symbols with an empty profile and that one is cached
+        try:
+            profile = self.get_symbol_profile(symbol)
+            if not isinstance(profile, dict): raise Exception(f"Finnhub: unexpected profile for '{symbol}': {profile}")
+            return profile
+        except Exception as error:
+            self.logging.error(f"{error}")
+            return None
+
     def index_stock_symbols(self, exchange):
         exchange = exchange.strip().upper()
-        self.logging.info(f"Indexing {exchange} stock symbols...")
+        symbols = sorted(self.get_stock_symbols(exchange), key=lambda _s: _s.get('symbol', ''))
+        started = time.time()
+        # an unfinished run continues after its last indexed symbol, with the same document DATE
+        checkpoint = self.get_checkpoint(exchange)
+        date = checkpoint.get('date', datetime.datetime.now().isoformat())
+        pending = [_s for _s in symbols if _s.get('symbol', '') > checkpoint.get('symbol', '')]
+        self.logging.info(f"Indexing {exchange} stock symbols: {len(pending)}/{len(symbols)}{' (resumed)' if len(checkpoint) > 0 else ''}")
+
+        result = { 'exchange': exchange, 'total': len(symbols), 'resumed': len(symbols)-len(pending), 'fetched': 0, 'indexed': 0, 'unchanged': 0, 'removed': 0 }
+        done = result['resumed']
+        # documents are sent in chunks as profiles arrive, the checkpoint moves after each indexed chunk
+        for chunk in util.chunks(pending, self.params.get('chunksize', 500)):
+            fetched, indexed = self.index_symbols_chunk(exchange, date, chunk)
+            self.save_checkpoint(exchange, chunk[-1].get('symbol'), date)
+            done += len(chunk)
+            result['fetched'] += fetched
+            result['indexed'] += indexed
+            result['unchanged'] += len(chunk) - indexed
+            self.logging.info(f"STOCK {exchange}: {done}/{len(symbols)} symbols, {result['indexed']} indexed")
+
+        delisted = list(set(self.cached_symbols(exchange)).difference([_s.get('symbol') for _s in symbols]))
+        if len(delisted) > 0:
+            self.sink.delete([f"{exchange}_{symbol}" for symbol in delisted])
+            self.remove_profiles(exchange, delisted)
+        self.save_checkpoint(exchange, None)
+        result.update({ 'removed': len(delisted), 'secs': round(time.time() - started, 3) })
+        self.logging.info(f"STOCK {exchange}: {result}")
+        return result
+
+    @retry(wait_fixed=10000, stop_max_delay=90000)
+    def index_symbols_chunk(self, exchange, date, symbols):
+        started = time.time()
+        cached = self.cached_profiles(exchange, [_s.get('symbol') for _s in symbols])
+        # only new symbols and profiles older than the ttl are fetched again
+        ttl = self.params.get('profilettl', 604800)
+        expired = [_s.get('symbol') for _s in symbols if started - cached.get(_s.get('symbol'), {}).get('fetched', 0) >= ttl]
+        fetched = self.fetch_profiles(exchange, expired)
+
         docsToIndex = []
-        date = datetime.datetime.now().isoformat()
-        url = f"{self.config.get('url')}/stock/symbol"
-        query = {'token':self.config.get('api'), 'exchange':exchange}
-        headers = {'X-Finnhub-Secret': self.config.get('key')}
-        response = requests.request('GET', url, headers=headers, params=query)
-        try:
-            response = response.json()
-            for _s in response:
-                _p = {}
-                try:
-                    _p = self.get_symbol_profile(_s.get('symbol'))
-                except Exception as error:
-                    self.logging.error(f"{error}")
-                self.logging.info(_p)
-
-                shares = float(_p.get('shareOutstanding', 0))
-                capitl = float(_p.get('marketCapitalization', 0))
-                price =  (capitl / shares) if capitl > 0 and shares > 0 else 0
-
-                # TODO use the idol webconnector to retrieve contents from the 'weburl' then index its bests concepts
-                docsToIndex.append({
-                    'reference': f"{exchange}_{_s.get('symbol')}",
-                    'dbname': self.config.get('database'),
-                    'drecontent': _p.get('name', _s.get('description', _s.get('symbol'))),
-                    'fields': [
-                        ('LANGUAGE', 'GENERALUTF8'),
-                        ('DATE', date),
-                        ('TITLE', f"{_p.get('name', _s.get('description'))} ({_s.get('symbol')})"),
-                        ('DISPLAYSYMBOL',  _s.get('displaySymbol')),
-                        ('SYMBOL_MATCH',  _s.get('symbol')),
-                        ('DESCRIPTION',  _s.get('description')),
-                        ('EXCHANGE_PARAM',  exchange),
-                        ('EXCHANGE',  _p.get('exchange', '')),
-                        ('IPO_DATE', _p.get('ipo', '')),
-                        ('URL', _p.get('weburl', '')),
-                        ('LOGO', _p.get('logo', '')),
-                        ('COUNTRY_PARAM', _p.get('country', '')),
-                        ('CURRENCY_PARAM', _p.get('currency', '')),
-                        ('FINNHUBINDUSTRY_PARAM', _p.get('finnhubIndustry', '')),
-                        ('SHAREOUTSTANDING_NUM', shares),
-                        ('MARKETCAPITALIZATION_NUM', capitl),
-                        ('SINGLESHAREPRICE_NUM', price)
-                    ]  
-                })
-        except Exception as error:
-            self.logging.error(f"{response} - {str(error)}")
-            raise error
-
-        query = {
-            'DREDbName': self.config.get('database'),
-            'KillDuplicates': 'REFERENCE',
-            'CreateDatabase': True,
-            'KeepExisting': False,
-            'Priority': 0
+        updates = []
+        for _s in symbols:
+            symbol = _s.get('symbol')
+            cache = cached.get(symbol, {})
+            _p = fetched.get(symbol)
+            update = {}
+            if _p != None: update.update({ 'profile': _p, 'fetched': started })
+            else: _p = cache.get('profile', {}) # not fetched or failed, keeps the cached profile
+            doc = self.symbol_document(exchange, date, _s, _p)
+            doc_hash = document_hash(doc)
+            if doc_hash != cache.get('hash'): # only changed documents are sent
+                docsToIndex.append(doc)
+                update['hash'] = doc_hash
+            if len(update) > 0:
+                updates.append(pymongo.UpdateOne({ 'exchange': exchange, 'symbol': symbol }, { '$set': update }, upsert=True))
+
+        if len(docsToIndex) > 0:
+            # the chunk must be confirmed by every sink before the cache and the checkpoint move on
+            written = self.sink.write(docsToIndex)
+            self.sink.flush(self.params.get('sinktimeout', 600))
+            # documents are keyed by reference, so a retry after a timeout at worst writes some of them twice
+            if not written.wait(self.params.get('sinktimeout', 600)):
+                raise Exception(f"STOCK {exchange}: chunk '{symbols[0].get('symbol')}'..'{symbols[-1].get('symbol')}' not confirmed after {self.params.get('sinktimeout', 600)} secs")
+            if written.errors() > 0:
+                raise Exception(f"STOCK {exchange}: chunk '{symbols[0].get('symbol')}'..'{symbols[-1].get('symbol')}' not written, {written.errors()} errors")
+        self.save_profiles(updates)
+        return len(expired), len(docsToIndex)
+
+    def fetch_profiles(self, exchange, symbols):
+        profiles = {}
+        started = time.time()
+        progress = self.params.get('progress', 500)
+        # profiles are fetched concurrently, the shared limiter keeps the pool at the quota rate
+        for done, (symbol, _p) in enumerate(zip(symbols, self.profiles_executor.map(self.get_profile, symbols)), 1):
+            self.logging.debug(_p)
+            profiles[symbol] = _p
+            if done % progress == 0 or done == len(symbols):
+                elapsed = time.time() - started
+                self.logging.info(f"STOCK {exchange}: {done}/{len(symbols)} profiles, {done/elapsed if elapsed > 0 else 0:.1f}/s, limit {self.limiter.rate*60:.1f}/min")
+        return profiles
+
+    def cached_profiles(self, exchange, symbols):
+        if self.mongo_profiles == None: return {}
+        return { _c['symbol']: _c for _c in self.mongo_profiles.find({ 'exchange': exchange, 'symbol': { '$in': symbols } }) }
+
+    def cached_symbols(self, exchange):
+        if self.mongo_profiles == None: return []
+        return self.mongo_profiles.distinct('symbol', { 'exchange': exchange })
+
+    def save_profiles(self, updates):
+        if self.mongo_profiles == None or len(updates) == 0: return
+        self.mongo_profiles.bulk_write(updates, ordered=False)
+
+    def remove_profiles(self, exchange, symbols):
+        if self.mongo_profiles == None: return
+        self.mongo_profiles.delete_many({ 'exchange': exchange, 'symbol': { '$in': symbols } })
+
+    def get_checkpoint(self, exchange):
+        if self.mongo_checkpoints == None: return {}
+        checkpoint = self.mongo_checkpoints.find_one({ 'task_id': self.task_id, 'exchange': exchange }) or {}
+        if time.time() - checkpoint.get('updated', 0) > self.params.get('checkpointttl', 86400): return {} # too old, start over
+        return { 'symbol': checkpoint['symbol'], 'date': checkpoint['date'] }
+
+    def save_checkpoint(self, exchange, symbol, date=None):
+        # a finished exchange removes its checkpoint
+        if self.mongo_checkpoints == None: return
+        if symbol == None:
+            self.mongo_checkpoints.delete_one({ 'task_id': self.task_id, 'exchange': exchange })
+        else:
+            self.mongo_checkpoints.update_one({ 'task_id': self.task_id, 'exchange': exchange }, { '$set': { 'symbol': symbol, 'date': date, 'updated': time.time() } }, upsert=True)
+
+    def symbol_document(self, exchange, date, _s, _p):
+        shares = float(_p.get('shareOutstanding', 0))
+        capitl = float(_p.get('marketCapitalization', 0))
+        price =  (capitl / shares) if capitl > 0 and shares > 0 else 0
+
+        # TODO use the idol webconnector to retrieve contents from the 'weburl' then index its bests concepts
+        return {
+            'reference': f"{exchange}_{_s.get('symbol')}",
+            'dbname': self.params.get('database'),
+            'drecontent': _p.get('name', _s.get('description', _s.get('symbol'))),
+            'fields': [
+                ('LANGUAGE', 'GENERALUTF8'),
+                ('DATE', date),
+                ('TITLE', f"{_p.get('name', _s.get('description'))} ({_s.get('symbol')})"),
+                ('DISPLAYSYMBOL',  _s.get('displaySymbol')),
+                ('SYMBOL_MATCH',  _s.get('symbol')),
+                ('DESCRIPTION',  _s.get('description')),
+                ('EXCHANGE_PARAM',  exchange),
+                ('EXCHANGE',  _p.get('exchange', '')),
+                ('IPO_DATE', _p.get('ipo', '')),
+                ('URL', _p.get('weburl', '')),
+                ('LOGO', _p.get('logo', '')),
+                ('COUNTRY_PARAM', _p.get('country', '')),
+                ('CURRENCY_PARAM', _p.get('currency', '')),
+                ('FINNHUBINDUSTRY_PARAM', _p.get('finnhubIndustry', '')),
+                ('SHAREOUTSTANDING_NUM', shares),
+                ('MARKETCAPITALIZATION_NUM', capitl),
+                ('SINGLESHAREPRICE_NUM', price)
+            ]  
         }
-        self.idol.index_into_idol(docsToIndex, query)
-        return { 'url': url, 'total': len(docsToIndex), 'indexed': len(docsToIndex) }
@@ -2,12 +2,16 @@ import os
 import re
 import time
 import json
+import random
 import string
 import logging
 #import psutil
 #import threading
 import html
-import html2text
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
 from copy import deepcopy
 from bson import ObjectId
 from requests.structures import CaseInsensitiveDict
@@ -20,6 +24,17 @@ FIELDSUFFIX_TAGGED = '_TAGGED'
 FIELDSUFFIX_TRAINED = '_TRAINED'
 DFLT_LANGUAGE = 'GENERAL'
 DFLT_ENCODE = 'UTF8'
+CLEAN_CACHE_SIZE = 4096 # entries
+CLEAN_CACHE_MAXLEN = 1024 # longer texts are cleaned without caching
+CLEAN_BATCH_MIN = 256
+
+re_html_drop = re.compile(r'<(script|style|head|title|noscript)\b[^>]*>.*?</\1\s*>|<!--.*?-->', re.IGNORECASE|re.DOTALL)
+re_html_block = re.compile(r'<\s*(br|hr|/?p|/?div|/?li|/?ul|/?ol|/?h[1-6]|/?tr|/?table|/?blockquote|/?pre|/?section|/?article)\b[^>]*>', re.IGNORECASE)
+re_html_tag = re.compile(r'</?[a-zA-Z!][^>]*>')
+re_blanks = re.compile(r'[^\S\n]+')
+re_newlines = re.compile(r' ?\n[\s]*')
+clean_pools = {} # processes -> ProcessPoolExecutor, shared by all callers
+clean_pools_lock = threading.Lock()
 
 ## --------- helper functions ------------
 def makeUrl(component):
@@ -37,14 +52,62 @@ def aciQuery(query, modify={}):
 def hashDict(dct):
     return str(hash(frozenset(dct.items())))
 
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
 def cleanText(text):
-    text_maker = html2text.HTML2Text()
-    text_maker.ignore_links = True
-    text_maker.ignore_images = True
-    text = html.unescape(text)
-    text = text_maker.handle(text)
-    text = text.strip().capitalize()
-    return text
+    if not text: return ''
+    if len(text) > CLEAN_CACHE_MAXLEN: return _cleanText(text)
+    return _cachedCleanText(text)
+
+def _cleanText(text):
+    # entities are decoded before and after stripping tags, feeds often carry escaped html
+    if '&' in text: text = html.unescape(text)
+    if '<' in text:
+        text = re_html_drop.sub(' ', text)
+        text = re_html_block.sub('\n', text)
+        text = re_html_tag.sub(' ', text)
+        if '&' in text: text = html.unescape(text)
+    text = re_newlines.sub('\n', re_blanks.sub(' ', text))
+    return text.strip().capitalize()
+
+_cachedCleanText = functools.lru_cache(maxsize=CLEAN_CACHE_SIZE)(_cleanText)
+
+def cleanTexts(texts:list, processes=0):
+    # large batches can be spread over a process pool, one pool per size shared by all callers
+    if processes <= 1 or len(texts) < CLEAN_BATCH_MIN:
+        return [cleanText(text) for text in texts]
+    with clean_pools_lock:
+        if processes not in clean_pools:
+            # spawned, forking a process with running crawler threads can deadlock the children on inherited locks
+            clean_pools[processes] = concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        pool = clean_pools[processes]
+    return list(pool.map(cleanText, texts, chunksize=64))
+
+def idolToElastic(doc):
+    # idx document (reference, drecontent, fields) into an elastic document, field names lowercased
+    fields = {}
+    for name, value in doc.get('fields', []):
+        fields.setdefault(name.lower(), value)
+    return dict(fields, _id=doc.get('reference'), content=doc.get('drecontent', ''))
+
+def elasticToIdol(doc, dbname=None):
+    # elastic document into an idx document, lists and dicts become repeated fields
+    fields = []
+    for name, value in doc.items():
+        if name in ('_id', 'content') or value == None: continue
+        for _v in (value if isinstance(value, (list, dict)) else [value]):
+            fields.append((name.upper(), _v))
+    if 'LANGUAGE' not in [_f[0] for _f in fields]:
+        fields.insert(0, ('LANGUAGE', f"{DFLT_LANGUAGE}{DFLT_ENCODE}"))
+    return { 'reference': str(doc.get('_id', doc.get('url'))), 'dbname': dbname, 'drecontent': doc.get('content', ''), 'fields': fields }
 
 def cleanDjangoError(response):
     errors = [cleanText(str(e)) for e in (response or {}).get('errors',['error'])]
@@ -183,7 +246,6 @@ def getDataFilename(config, name, sufx=None, ext='dat', trunc=False, delt=False)
 
 def createTrainDataQuery(proj, lang):
     return {
-            "from" : 0, "size" : 1000,
             "query": {
                 "bool" : {
                     "must" : {
@@ -205,6 +267,16 @@ def createTrainDataQuery(proj, lang):
             }
         }
 
+def reservoirSample(iterable, size):
+    sample = []
+    for i, item in enumerate(iterable):
+        if i < size:
+            sample.append(item)
+        else:
+            j = random.randint(0, i)
+            if j < size: sample[j] = item
+    return sample
+
 def dump_json(dic:dict):
     return dumps(dic)
 